@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from batch_engine import BatchEngine, DEATHS, FIELDS
+from rules import RULES_FILE, Attack, Shield, load_rules
+
+"""
+Monte Carlo balance simulation on the engine rules.
+
+Every step, in every match, a random player performs an action drawn from the
+action distribution. Before the action the player sees the opponent with
+probability --visible-rate and has one rain bomb on the opponent with probability
+--rain-rate. Example:
+
+    python balance_sim.py --matches 100000 --steps 300 --actions gun=4,shield=1,basket=1,reload=2 --hit-rates gun=0.6
+"""
+
+PERCENTILES = (50, 90, 99)
+
+def parse_weights(spec, default):
+    # "gun=0.4,shield=0.1" -> {'gun': 0.4, 'shield': 0.1}
+    weights = dict(default)
+    if spec:
+        for item in spec.split(','):
+            name, _, value = item.partition('=')
+            weights[name.strip()] = float(value)
+    return weights
+
+def consumed_resource(action):
+    # (field, cost) an action needs to have any effect, or None
+    if isinstance(action, Attack) and action.resource is not None:
+        return action.resource, action.cost
+    if isinstance(action, Shield):
+        return 'shields', 1
+    return None
+
+def simulate(rules_file, matches, steps, actions, probabilities, hit_rates, visible_rate, rain_rate, seed):
+    # Simulate one chunk of matches, runs in a worker process
+    rng = np.random.default_rng(seed)
+    engine = BatchEngine(matches, load_rules(rules_file))
+    all_matches = np.arange(matches)
+    codes = engine.encode_actions(actions)
+    hit_rate = np.array([hit_rates.get(action, 1.0) for action in actions])
+    # Per action: the field it consumes and how much, to spot resource exhaustion
+    consumed = [consumed_resource(engine.rules.actions.get(action)) for action in actions]
+    resource = np.array([FIELDS.index(c[0]) if c else -1 for c in consumed])
+    cost = np.array([c[1] if c else 0 for c in consumed])
+
+    first_death = np.full(matches, -1, dtype=np.int64)
+    attempts = np.zeros(len(actions), dtype=np.int64)
+    exhausted = np.zeros(len(actions), dtype=np.int64)
+    for step in range(steps):
+        player_id = rng.integers(1, 3, matches)
+        choice = rng.choice(len(actions), matches, p=probabilities)
+        hit = rng.random(matches) < hit_rate[choice]
+        engine.update_internal_game_state(all_matches, player_id, 'opponent_visible', rng.random(matches) < visible_rate)
+        engine.update_internal_game_state(all_matches, player_id, 'opponent_in_rain_bomb', rng.random(matches) < rain_rate)
+
+        # A shield also fails while one is still up, but only an empty stock counts as exhaustion
+        uses = resource[choice] >= 0
+        stock = engine.state[np.maximum(resource[choice], 0), all_matches, player_id - 1]
+        attempts += np.bincount(choice, minlength=len(actions))
+        exhausted += np.bincount(choice[uses & (stock < cost[choice])], minlength=len(actions))
+
+        engine.perform_actions(all_matches, player_id, codes[choice], hit)
+        died = (first_death < 0) & (engine.state[DEATHS].sum(axis=1) > 0)
+        first_death[died] = step + 1
+
+    return first_death, engine.state[DEATHS].sum(axis=1), attempts, exhausted
+
+def describe(values):
+    if len(values) == 0:
+        return 'n/a'
+    percentiles = ', '.join(f'p{p} {np.percentile(values, p):.1f}' for p in PERCENTILES)
+    return f'mean {values.mean():.2f}, {percentiles}, max {values.max()}'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Monte Carlo balance simulation of the game engine rules')
+    parser.add_argument('--rules', default=RULES_FILE, help='rules file to simulate')
+    parser.add_argument('--matches', type=int, default=10000)
+    parser.add_argument('--steps', type=int, default=200, help='actions per match')
+    parser.add_argument('--actions', help='relative action weights, e.g. gun=4,shield=1 (default: every action except logout, equally)')
+    parser.add_argument('--hit-rates', help='hit probability per action, e.g. gun=0.6 (default 1)')
+    parser.add_argument('--visible-rate', type=float, default=0.8, help='probability the opponent is visible on an action')
+    parser.add_argument('--rain-rate', type=float, default=0.1, help='probability one rain bomb is on the opponent on an action')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    rules = load_rules(args.rules)
+    weights = parse_weights(args.actions, {} if args.actions else {name: 1.0 for name in rules.actions if name != 'logout'})
+    actions = list(weights)
+    probabilities = np.array([weights[action] for action in actions])
+    probabilities /= probabilities.sum()
+    hit_rates = parse_weights(args.hit_rates, {})
+
+    # Split the matches evenly over the workers, each with an independent random stream
+    workers = max(1, min(args.workers, args.matches))
+    chunks = [len(chunk) for chunk in np.array_split(np.arange(args.matches), workers)]
+    seeds = np.random.SeedSequence(args.seed).spawn(workers)
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(
+            simulate,
+            [args.rules] * workers, chunks, [args.steps] * workers, [actions] * workers,
+            [probabilities] * workers, [hit_rates] * workers, [args.visible_rate] * workers,
+            [args.rain_rate] * workers, seeds,
+        ))
+
+    first_death = np.concatenate([result[0] for result in results])
+    deaths = np.concatenate([result[1] for result in results])
+    attempts = sum(result[2] for result in results)
+    exhausted = sum(result[3] for result in results)
+
+    killed = first_death[first_death > 0]
+    print(f'Simulated {args.matches} matches of {args.steps} actions on {workers} workers')
+    print(f'Time to first kill (actions): {describe(killed)}')
+    print(f'Matches without a kill: {(first_death < 0).mean():.1%}')
+    print(f'Deaths per match: {describe(deaths)}')
+    print('Resource exhaustion (attempts made with nothing left):')
+    for action, tried, failed in zip(actions, attempts, exhausted):
+        if consumed_resource(rules.actions.get(action)):
+            print(f'  {action:<10} {failed / max(tried, 1):7.1%} of {tried} attempts')
+
+if __name__ == '__main__':
+    main()
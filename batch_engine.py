@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import numpy as np
+from rules import Attack, Logout, Reload, Shield, load_rules
+
+# Player fields, each stored as one (matches, 2) array in BatchEngine.state
+FIELDS = (
+    'hp',
+    'bullets',
+    'bombs',
+    'shield_hp',
+    'deaths',
+    'shields',
+    'opponent_visible',
+    'opponent_in_rain_bomb',
+    'disconnected',
+    'login',
+)
+HP, BULLETS, BOMBS, SHIELD_HP, DEATHS, SHIELDS, OPPONENT_VISIBLE, OPPONENT_IN_RAIN_BOMB, DISCONNECTED, LOGIN = range(len(FIELDS))
+BOOL_FIELDS = (OPPONENT_VISIBLE, DISCONNECTED, LOGIN)
+
+# Action code of action types the rules do not know, which do nothing
+NO_ACTION = -1
+
+class BatchEngine:
+    # Struct-of-arrays version of Match.perform_action for simulating many matches at
+    # once. Player 1 and 2 of match m live at [m, 0] and [m, 1] of every field array
+    def __init__(self, matches, rules=None):
+        self.rules = rules if rules is not None else load_rules()
+        self.matches = matches
+        self.state = np.zeros((len(FIELDS), matches, 2), dtype=np.int64)
+        self.state[HP] = self.rules.hp
+        self.state[BULLETS] = self.rules.bullets
+        self.state[BOMBS] = self.rules.bombs
+        self.state[SHIELDS] = self.rules.shields
+        self.compile_actions()
+
+    def compile_actions(self):
+        # Flatten the rules' action handlers into per-code lookup arrays
+        self.action_names = list(self.rules.actions)
+        self.action_codes = {name: code for code, name in enumerate(self.action_names)}
+        count = len(self.action_names)
+        self.is_attack = np.zeros(count, dtype=bool)
+        self.is_reload = np.zeros(count, dtype=bool)
+        self.is_shield = np.zeros(count, dtype=bool)
+        self.is_logout = np.zeros(count, dtype=bool)
+        self.damage = np.zeros(count, dtype=np.int64)
+        self.resource = np.full(count, -1, dtype=np.int64)
+        self.cost = np.zeros(count, dtype=np.int64)
+        self.needs_visible = np.zeros(count, dtype=bool)
+        self.needs_hit = np.zeros(count, dtype=bool)
+        for code, action in enumerate(self.rules.actions.values()):
+            if isinstance(action, Attack):
+                self.is_attack[code] = True
+                self.damage[code] = action.damage
+                if action.resource is not None:
+                    self.resource[code] = FIELDS.index(action.resource)
+                self.cost[code] = action.cost
+                self.needs_visible[code] = action.needs_visible
+                self.needs_hit[code] = action.needs_hit
+            elif isinstance(action, Reload):
+                self.is_reload[code] = True
+            elif isinstance(action, Shield):
+                self.is_shield[code] = True
+            elif isinstance(action, Logout):
+                self.is_logout[code] = True
+            else:
+                raise ValueError(f'Action {action.name!r} of type {type(action).__name__} cannot be batched')
+
+    def encode_actions(self, action_types):
+        # Action type names to codes for perform_actions
+        return np.array([self.action_codes.get(action_type, NO_ACTION) for action_type in action_types], dtype=np.int64)
+
+    def update_internal_game_state(self, match, player_id, field, values):
+        # Vectorized counterpart of Match.update_internal_game_state for one field
+        self.state[FIELDS.index(field), np.asarray(match), np.asarray(player_id) - 1] = values
+
+    def to_wire(self, match):
+        # game_state of one match in the same form as Match.to_wire
+        game_state = {}
+        for index, player_key in enumerate(('p1', 'p2')):
+            player = {}
+            for field, name in enumerate(FIELDS):
+                value = int(self.state[field, match, index])
+                player[name] = bool(value) if field in BOOL_FIELDS else value
+            game_state[player_key] = player
+        return game_state
+
+    def perform_actions(self, match, player_id, action, hit):
+        # Apply a batch of (match, player_id, action code, hit) rows as if each row
+        # were a Match.perform_action call, in row order. Rows of different matches
+        # are independent, so the batch is cut into waves holding at most one row per
+        # match and each wave is applied with whole-array operations
+        match = np.asarray(match, dtype=np.int64)
+        player = np.asarray(player_id, dtype=np.int64) - 1
+        action = np.asarray(action, dtype=np.int64)
+        hit = np.asarray(hit, dtype=bool)
+        if len(match) == 0:
+            return
+
+        # Rank of every row among the rows of its match, in row order
+        order = np.argsort(match, kind='stable')
+        sorted_match = match[order]
+        group_start = np.flatnonzero(np.r_[True, sorted_match[1:] != sorted_match[:-1]])
+        group_sizes = np.diff(np.r_[group_start, len(match)])
+        rank = np.empty(len(match), dtype=np.int64)
+        rank[order] = np.arange(len(match)) - np.repeat(group_start, group_sizes)
+
+        for wave in range(int(group_sizes.max())):
+            rows = np.flatnonzero(rank == wave)
+            self.perform_wave(match[rows], player[rows], action[rows], hit[rows])
+
+    def perform_wave(self, m, p, action, hit):
+        rules = self.rules
+        s = self.state
+        o = 1 - p
+        known = action != NO_ACTION
+        code = np.where(known, action, 0)
+        opponent_visible = s[OPPONENT_VISIBLE, m, p].astype(bool)
+        opponent_in_rain_bomb = s[OPPONENT_IN_RAIN_BOMB, m, p]
+
+        # Attacks, consuming their resource when there is enough of it
+        attack = known & self.is_attack[code] & (~self.needs_visible[code] | opponent_visible)
+        resource = self.resource[code]
+        uses_resource = attack & (resource >= 0)
+        remaining = s[np.maximum(resource, 0), m, p] - self.cost[code]
+        consumed = uses_resource & (remaining >= 0)
+        s[resource[consumed], m[consumed], p[consumed]] = remaining[consumed]
+        lands = attack & ~(uses_resource & ~consumed) & (~self.needs_hit[code] | hit)
+        damage_to_opponent = np.where(lands, self.damage[code], 0)
+
+        # Reload only on an empty magazine
+        reload = known & self.is_reload[code] & (s[BULLETS, m, p] == 0)
+        s[BULLETS, m[reload], p[reload]] = rules.bullets
+
+        # Shield only if one is left and none is up
+        shield = known & self.is_shield[code] & (s[SHIELDS, m, p] > 0) & (s[SHIELD_HP, m, p] == 0)
+        s[SHIELDS, m[shield], p[shield]] -= 1
+        s[SHIELD_HP, m[shield], p[shield]] = rules.shield_hp
+
+        logout = known & self.is_logout[code]
+        s[LOGIN, m[logout], p[logout]] = 0
+
+        # Rain damage
+        rain = (opponent_in_rain_bomb > 0) & opponent_visible
+        damage_to_opponent += np.where(rain, rules.rain_bomb_damage * opponent_in_rain_bomb, 0)
+
+        # Opponent's shield absorbs damage first
+        opponent_shield_hp = s[SHIELD_HP, m, o]
+        absorbed = np.where((opponent_shield_hp > 0) & (damage_to_opponent > 0), np.minimum(damage_to_opponent, opponent_shield_hp), 0)
+        s[SHIELD_HP, m, o] = np.maximum(opponent_shield_hp - absorbed, 0)
+        damage_to_opponent -= absorbed
+
+        # Remaining damage to HP, respawning dead opponents
+        s[HP, m, o] -= np.maximum(damage_to_opponent, 0)
+        died = (damage_to_opponent > 0) & (s[HP, m, o] <= 0)
+        dm, do = m[died], o[died]
+        s[HP, dm, do] = rules.hp
+        s[DEATHS, dm, do] += 1
+        s[SHIELDS, dm, do] = rules.shields
+        s[SHIELD_HP, dm, do] = 0
+        s[BULLETS, dm, do] = rules.bullets
+        s[BOMBS, dm, do] = rules.bombs
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import json
+import os
+import time
+from dotenv import load_dotenv
+from metrics import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Wire format for every message the game engine consumes and publishes: json, orjson or msgpack.
+# All producers and consumers of update_ge_queue, update_eval_server_queue and
+# update_everyone must agree on it
+CODEC = os.getenv('CODEC', 'json')
+
+class Codec:
+    def __init__(self, name, content_type, encode, decode):
+        self.name = name
+        self.content_type = content_type
+        # encode(obj) -> bytes, decode(bytes) -> obj
+        self.encode = encode
+        self.decode = decode
+
+def _json_codec():
+    def encode(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    # json.loads accepts bytes directly, no need to decode to str first
+    return Codec('json', 'application/json', encode, json.loads)
+
+def _orjson_codec():
+    import orjson
+    return Codec('orjson', 'application/json', orjson.dumps, orjson.loads)
+
+def _msgpack_codec():
+    import msgpack
+    def encode(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+    return Codec('msgpack', 'application/msgpack', encode, decode)
+
+CODECS = {
+    'json': _json_codec,
+    'orjson': _orjson_codec,
+    'msgpack': _msgpack_codec,
+}
+
+def get_codec(name=CODEC):
+    try:
+        factory = CODECS[name]
+    except KeyError:
+        raise ValueError(f'Unknown codec {name!r}, available: {", ".join(CODECS)}')
+    try:
+        return factory()
+    except ImportError as e:
+        raise ImportError(f'Codec {name!r} requires the {e.name} package') from e
+
+# Codec selected by the CODEC environment variable
+codec = get_codec()
+
+class Payload:
+    # An outgoing message encoded exactly once. The same bytes are shared by every
+    # sink (RabbitMQ, MQTT) and the pretty form used for logging is derived from them
+    __slots__ = ('message', 'body', '_pretty')
+
+    def __init__(self, message):
+        self.message = message
+        # Encode eagerly so later changes to the live game state cannot leak into it
+        if metrics.enabled:
+            start = time.perf_counter()
+            self.body = codec.encode(message)
+            metrics.observe_serialization('encode', time.perf_counter() - start)
+        else:
+            self.body = codec.encode(message)
+        self._pretty = None
+
+    def pretty(self):
+        # Indented JSON of exactly what was sent, built on first use only
+        if self._pretty is None:
+            self._pretty = json.dumps(codec.decode(self.body), indent=2)
+        return self._pretty
+
+    # Lets a Payload be passed straight to lazy log calls
+    __str__ = pretty
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from codec import Payload
+from engine_log import Pretty
+from metrics import metrics
+from rules import RULES_FILE, load_rules
+from tracing import tracer
+
+# Load environment variables from .env file
+load_dotenv()
+
+log = logging.getLogger('game_engine')
+
+"""
+Sans-IO core of the game engine: game rules and match state only. EngineCore takes
+decoded update_ge_queue messages and returns effects (Publish, ScheduleFlush) for a
+transport to carry out, see GameEngine in game_engine.py for the RabbitMQ/MQTT one
+and replay.py for offline runs. Nothing in here does I/O or awaits.
+"""
+
+# MQTT topic
+MQTT_TOPIC_UPDATE_EVERYONE = os.getenv('MQTT_TOPIC_UPDATE_EVERYONE', 'update_everyone')
+
+# Delta mode: update_everyone messages carry only the fields changed since the
+# previous publish of the match, plus a full keyframe every MQTT_KEYFRAME_INTERVAL
+# publishes, for the first publish of a match, and whenever a message asks for one
+MQTT_DELTA = os.getenv('MQTT_DELTA', 'false').lower() == 'true'
+MQTT_KEYFRAME_INTERVAL = int(os.getenv('MQTT_KEYFRAME_INTERVAL', '20'))
+
+# When above zero, 'update' publishes of a match are coalesced: the first update
+# opens a window of this many milliseconds and only the state at the end of the
+# window is published. Action results are always published immediately
+MQTT_COALESCE_MS = int(os.getenv('MQTT_COALESCE_MS', '0'))
+
+# Most matches that can be live at once, so producers cannot grow the registry
+# without end. Matches are removed by an "end_match" message
+GE_MAX_MATCHES = int(os.getenv('GE_MAX_MATCHES', '1000'))
+
+def check_match_id(match_id):
+    # A match_id becomes an MQTT topic level, so only non-empty strings without
+    # wildcards or level separators are accepted; being strings only also keeps 5 and
+    # "5" from becoming two matches publishing on one topic. None is the default match
+    if match_id is None:
+        return None
+    if not isinstance(match_id, str) or not match_id or any(c in match_id for c in '+#/\0'):
+        raise ValueError(f'Invalid match_id {match_id!r}, must be a non-empty string without +, #, / or NUL')
+    return match_id
+
+# Messages without a match_id belong to the default match, which keeps publishing
+# on the bare MQTT_TOPIC_UPDATE_EVERYONE topic so existing nodes keep working
+DEFAULT_MATCH_ID = check_match_id(os.getenv('DEFAULT_MATCH_ID') or None)
+
+def match_topic(match_id):
+    # Each match publishes on its own sub-topic of MQTT_TOPIC_UPDATE_EVERYONE
+    if match_id is None:
+        return MQTT_TOPIC_UPDATE_EVERYONE
+    return f'{MQTT_TOPIC_UPDATE_EVERYONE}/{match_id}'
+
+class PlayerState:
+    # Fixed set of fields per player. Incoming updates can only touch these fields,
+    # with values of the right type, so untrusted input cannot grow the state
+    FIELDS = {
+        'hp': int,
+        'bullets': int,
+        'bombs': int,
+        'shield_hp': int,
+        'deaths': int,
+        'shields': int,
+        'opponent_visible': bool,
+        'opponent_in_rain_bomb': int,  # Counter for rain bombs
+        'disconnected': bool,
+        'login': bool,
+    }
+    __slots__ = tuple(FIELDS)
+
+    def __init__(self, rules):
+        self.hp = rules.hp
+        self.bullets = rules.bullets
+        self.bombs = rules.bombs
+        self.shield_hp = 0
+        self.deaths = 0
+        self.shields = rules.shields
+        self.opponent_visible = False
+        self.opponent_in_rain_bomb = 0
+        self.disconnected = False
+        self.login = False
+
+    def update(self, incoming):
+        # Apply known fields from an incoming player dict, returns whether anything changed
+        changed = False
+        for key, value in incoming.items():
+            field_type = PlayerState.FIELDS.get(key)
+            # Exact type, since bool is a subclass of int and "hp": true must not pass
+            if field_type is None or type(value) is not field_type:
+                log.debug('Ignoring invalid player state field %s=%r', key, value)
+                continue
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+                changed = True
+        return changed
+
+    def to_wire(self):
+        return {
+            'hp': self.hp,
+            'bullets': self.bullets,
+            'bombs': self.bombs,
+            'shield_hp': self.shield_hp,
+            'deaths': self.deaths,
+            'shields': self.shields,
+            'opponent_visible': self.opponent_visible,
+            'opponent_in_rain_bomb': self.opponent_in_rain_bomb,
+            'disconnected': self.disconnected,
+            'login': self.login,
+        }
+
+class Match:
+    def __init__(self, match_id, rules):
+        self.match_id = match_id
+        # Compiled rules file, swapped by GameEngine.reload_rules
+        self.rules = rules
+        self.topic = match_topic(match_id)
+        # Incremented on every change to game_state, and the version last sent to nodes
+        self.version = 0
+        self.published_version = -1
+        # Encoded {"game_state": ...} payload, valid while its version matches
+        self._state_payload = None
+        # Delta mode: the game state as nodes last received it, and keyframe bookkeeping
+        self.published_state = None
+        self.publishes_since_keyframe = 0
+        self.keyframe_requested = False
+        # Initialize internal game state
+        self.game_state = {
+            'p1': PlayerState(rules),
+            'p2': PlayerState(rules),
+        }
+
+    def to_wire(self):
+        # game_state as plain dicts, ready to encode
+        game_state = self.game_state
+        return {'p1': game_state['p1'].to_wire(), 'p2': game_state['p2'].to_wire()}
+
+    def state_payload(self):
+        # Encoded snapshot of the current game state, re-encoded only after a mutation
+        if self._state_payload is None or self._state_payload[0] != self.version:
+            self._state_payload = (self.version, Payload(self.sync_message(keyframe=True)))
+        return self._state_payload[1]
+
+    def needs_keyframe(self):
+        if not MQTT_DELTA:
+            return self.keyframe_requested
+        return (self.keyframe_requested
+                or self.published_state is None
+                or self.publishes_since_keyframe >= MQTT_KEYFRAME_INTERVAL)
+
+    def sync_message(self, keyframe):
+        # Game state part of an update_everyone message
+        if not MQTT_DELTA:
+            return {"game_state": self.to_wire()}
+        if keyframe:
+            return {"version": self.version, "keyframe": True, "game_state": self.to_wire()}
+        # Only the fields that differ from what nodes were last sent
+        changes = {}
+        for player_key, player in self.to_wire().items():
+            published = self.published_state[player_key]
+            changed = {key: value for key, value in player.items() if published[key] != value}
+            if changed:
+                changes[player_key] = changed
+        return {"version": self.version, "base": self.published_version, "delta": True, "game_state": changes}
+
+    def mark_published(self, keyframe):
+        # Record what nodes now hold, for change detection and the next delta
+        self.published_version = self.version
+        self.keyframe_requested = False
+        if MQTT_DELTA:
+            self.published_state = self.to_wire()
+            self.publishes_since_keyframe = 0 if keyframe else self.publishes_since_keyframe + 1
+
+    def update_internal_game_state(self, incoming_game_state):
+        # Update internal game state with the incoming data, bumping the version only
+        # if some value actually changed
+        changed = False
+        for player_key in ['p1', 'p2']:
+            if player_key in incoming_game_state:
+                if self.game_state[player_key].update(incoming_game_state[player_key]):
+                    changed = True
+        if changed:
+            self.version += 1
+        return changed
+
+    def perform_action(self, player_id, action_type, data):
+        # Perform calculations based on action_type
+        player_key = f'p{player_id}'
+        opponent_key = 'p1' if player_key == 'p2' else 'p2'
+
+        player = self.game_state[player_key]
+        opponent = self.game_state[opponent_key]
+        # Every action result is published, so count it as a new version
+        self.version += 1
+
+        # Extract necessary data
+        opponent_visible = player.opponent_visible
+        opponent_in_rain_bomb = player.opponent_in_rain_bomb
+        hit = data.get('hit', False)
+
+        # Initialize damage variables
+        damage_to_opponent = 0
+        damage_to_shield = 0
+
+        # Handle actions
+        rules = self.rules
+        action = rules.actions.get(action_type)
+        if action is not None:
+            damage_to_opponent = action.apply(player_id, player, hit)
+        # Handle rain damage
+        if opponent_in_rain_bomb > 0 and opponent_visible:
+            damage_to_opponent += rules.rain_bomb_damage * opponent_in_rain_bomb  # Damage per rain bomb active
+
+        # Apply damage to opponent's shield first
+        if opponent.shield_hp > 0:
+            if damage_to_opponent > 0:
+                damage_to_shield = min(damage_to_opponent, opponent.shield_hp)
+                opponent.shield_hp -= damage_to_shield
+                damage_to_opponent -= damage_to_shield
+                log.debug('Damage to shield: %s. Shield HP left: %s', damage_to_shield, opponent.shield_hp)
+        else:
+            opponent.shield_hp = 0
+
+        # Apply remaining damage to opponent's HP
+        if damage_to_opponent > 0:
+            opponent.hp -= damage_to_opponent
+            log.debug('Damage to opponent HP: %s. HP left: %s', damage_to_opponent, opponent.hp)
+            if opponent.hp <= 0:
+                opponent.hp = rules.hp  # Rebirth with full HP
+                opponent.deaths += 1
+                opponent.shields = rules.shields
+                opponent.shield_hp = 0
+                opponent.bullets = rules.bullets
+                opponent.bombs = rules.bombs
+                log.debug('Player %s died and respawned.', opponent_key[-1])
+
+class Publish:
+    # Effect of handling a message: send an encoded payload of a match to a sink,
+    # 'eval_server' or 'mqtt' (on a topic, with the QoS of its message class)
+    __slots__ = ('sink', 'payload', 'topic', 'message_class', 'match_id')
+
+    def __init__(self, sink, payload, topic=None, message_class=None, match_id=None):
+        self.sink = sink
+        self.payload = payload
+        self.topic = topic
+        self.message_class = message_class
+        self.match_id = match_id
+
+class ScheduleFlush:
+    # Effect of handling a message: call flush_update(match_id) after delay seconds
+    __slots__ = ('match_id', 'delay')
+
+    def __init__(self, match_id, delay):
+        self.match_id = match_id
+        self.delay = delay
+
+class EngineCore:
+    def __init__(self, rules=None, coalesce_ms=MQTT_COALESCE_MS):
+        # Registry of live matches keyed by match_id, created on first message
+        self.matches = {}
+        self.rules = rules if rules is not None else load_rules()
+        # Matches with an update waiting for their coalescing window to close
+        self.coalesce_ms = coalesce_ms
+        self.pending_updates = set()
+
+    def get_match(self, match_id):
+        match = self.matches.get(match_id)
+        if match is None:
+            if len(self.matches) >= GE_MAX_MATCHES:
+                raise ValueError(f'Not starting match {match_id}, {GE_MAX_MATCHES} matches are already live')
+            match = Match(match_id, self.rules)
+            self.matches[match_id] = match
+            log.info('Created match %s publishing on %s', match_id, match.topic)
+        return match
+
+    def end_match(self, match_id):
+        # Forget a match, a later message with its match_id starts a fresh one
+        if self.matches.pop(match_id, None) is not None:
+            self.pending_updates.discard(match_id)
+            log.info('Ended match %s', match_id)
+
+    def reload_rules(self):
+        # Call between two messages, so no message sees a half swapped rule set
+        try:
+            rules = load_rules()
+        except (OSError, ValueError) as e:
+            log.error('Keeping current rules, failed to reload %s: %s', RULES_FILE, e)
+            return
+        self.rules = rules
+        for match in self.matches.values():
+            match.rules = rules
+        log.info('Reloaded rules from %s', RULES_FILE)
+
+    def update_effects(self, match):
+        # Publish of the match's current state to its nodes, if they do not have it yet
+        if match.version == match.published_version and not match.keyframe_requested:
+            log.debug('Game state of match %s unchanged since version %s, not publishing', match.match_id, match.version)
+            return []
+        keyframe = match.needs_keyframe()
+        if keyframe or not MQTT_DELTA:
+            # Reuse the encoded snapshot of this version
+            payload = match.state_payload()
+        else:
+            payload = Payload(match.sync_message(keyframe=False))
+        match.mark_published(keyframe)
+        return [Publish('mqtt', payload, match.topic, 'sync' if keyframe else 'update', match.match_id)]
+
+    def flush_update(self, match_id):
+        # Close the match's coalescing window, unless an action already closed it
+        if match_id not in self.pending_updates:
+            return []
+        self.pending_updates.discard(match_id)
+        return self.update_effects(self.matches[match_id])
+
+    def handle_message(self, data):
+        # Apply one decoded update_ge_queue message and return what has to be published
+        match_id = check_match_id(data.get('match_id', DEFAULT_MATCH_ID))
+        if data.get('end_match', False):
+            self.end_match(match_id)
+            return []
+        action_performed = data.get("action", False)
+        keyframe_requested = data.get("keyframe", False)
+        to_update = data.get("update", False) or keyframe_requested
+        player_id = data.get('player_id')
+        action_type = data.get('action_type')
+        incoming_game_state = data.get('game_state', {})
+        # Checked before anything changes, a rejected message must leave no trace
+        if action_performed and (type(player_id) is not int or player_id not in (1, 2)):
+            raise ValueError(f'Invalid player_id {player_id!r}, must be 1 or 2')
+
+        match = self.get_match(match_id)
+        if keyframe_requested:
+            match.keyframe_requested = True
+
+        # Update internal game state with non-action-related info
+        if tracer.enabled:
+            start = time.perf_counter()
+            match.update_internal_game_state(incoming_game_state)
+            tracer.record('state_update', time.perf_counter() - start)
+        else:
+            match.update_internal_game_state(incoming_game_state)
+
+        if action_performed:
+            # The action result carries the latest state, so a pending coalesced update is redundant
+            self.pending_updates.discard(match_id)
+            # Label by known action types only, so arbitrary input cannot add time series
+            metrics.actions[action_type if action_type in match.rules.actions else 'unknown'] += 1
+            # Perform action calculations before updating internal state
+            if tracer.enabled:
+                start = time.perf_counter()
+                match.perform_action(player_id, action_type, data)
+                tracer.record('perform_action', time.perf_counter() - start)
+            else:
+                match.perform_action(player_id, action_type, data)
+            # Prepare message to publish
+            mqtt_message = {
+                "game_state": match.to_wire(),
+                "action": action_type,
+                "player_id": player_id
+            }
+            if match_id is not None:
+                mqtt_message["match_id"] = match_id
+            # Encode once, both sinks and the logs share the same payload
+            payload = Payload(mqtt_message)
+            mqtt_payload = payload
+            keyframe = False
+            if MQTT_DELTA:
+                # Nodes get the versioned form, the eval server always the full state
+                keyframe = match.needs_keyframe()
+                mqtt_message.update(match.sync_message(keyframe))
+            trace = data.get('trace')
+            if isinstance(trace, dict):
+                # Echo the producer's timestamps to nodes, the eval server never sees them
+                mqtt_message["trace"] = trace
+            if MQTT_DELTA or isinstance(trace, dict):
+                mqtt_payload = Payload(mqtt_message)
+            match.mark_published(keyframe)
+            return [
+                Publish('eval_server', payload, match_id=match_id),
+                Publish('mqtt', mqtt_payload, match.topic, 'action', match_id),
+            ]
+        elif to_update:
+            if self.coalesce_ms > 0:
+                # Fold this update into the match's open window, or open a new one
+                if match_id not in self.pending_updates:
+                    self.pending_updates.add(match_id)
+                    return [ScheduleFlush(match_id, self.coalesce_ms / 1000)]
+                return []
+            return self.update_effects(match)
+        else:
+            # Only update internal game state without sending messages
+            log.debug('Game state of match %s updated internally: %s', match_id, Pretty(match.game_state))
+            log.debug('Updated internal game state without sending any messages')
+            return []
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# DEBUG prints every message and payload, INFO only connection and lifecycle events
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(processName)s: %(message)s'
+
+class Pretty:
+    # Defers json.dumps(indent=2) of a value until the record is actually formatted,
+    # so disabled DEBUG records never pay for it
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, indent=2, default=_to_wire)
+
+def _to_wire(value):
+    # Lets Pretty render objects such as PlayerState that know their wire form
+    to_wire = getattr(value, 'to_wire', None)
+    return to_wire() if to_wire is not None else str(value)
+
+def setup_logging(level=LOG_LEVEL, stream=None):
+    # Records are formatted on the calling thread (so payloads are captured as they
+    # were) and handed to a background thread that does the I/O to stream (stdout
+    # unless given), keeping the event loop free of blocking writes. Returns the
+    # listener so it can be stopped
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    return listener
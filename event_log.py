@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from dotenv import load_dotenv
+from codec import codec, get_codec
+
+# Load environment variables from .env file
+load_dotenv()
+
+log = logging.getLogger('game_engine')
+
+"""
+Append-only binary log of every update_ge_queue message the engine applied, with
+the version of its match after applying it. Sharded workers write EVENT_LOG_PATH.<shard>.
+
+File layout: a header (MAGIC, then the codec name as one length byte and ASCII) and
+then one record per message:
+
+    body length   uint32 LE
+    crc32         uint32 LE, over the version, time and body
+    version       uint64 LE, match version after the message was applied
+    time          float64 LE, wall clock when it was logged
+    body          the message exactly as received, in the codec of the header
+
+A crash can leave a torn record at the end, readers stop there and the writer cuts
+it off before appending. The engine only appends when it recovers from the log
+(EVENT_LOG_RECOVER); a fresh start moves the previous run's log to <path>.old, so
+a later recovery never mixes the records of two runs. To dump a log as JSONL, e.g. to feed it to replay.py:
+
+    python event_log.py events.log | python replay.py
+"""
+
+# Off unless set
+EVENT_LOG_PATH = os.getenv('EVENT_LOG_PATH') or None
+# fsync every group commit; without it a crash of the machine (not of the engine)
+# can lose the most recent records
+EVENT_LOG_FSYNC = os.getenv('EVENT_LOG_FSYNC', 'true').lower() == 'true'
+# Rebuild the matches from the log at startup
+EVENT_LOG_RECOVER = os.getenv('EVENT_LOG_RECOVER', 'false').lower() == 'true'
+
+MAGIC = b'GEEVLOG\x01'
+RECORD_HEADER = struct.Struct('<II')
+RECORD_META = struct.Struct('<Qd')
+
+def log_path(path, shard=None):
+    return path if shard is None else f'{path}.{shard}'
+
+def file_header(codec_name):
+    name = codec_name.encode('ascii')
+    return MAGIC + bytes((len(name),)) + name
+
+def read_header(f):
+    # Codec name of an open log file, positioned after the header
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError(f'{f.name} is not an event log')
+    length = f.read(1)
+    name = f.read(length[0]) if length else b''
+    if not length or len(name) != length[0]:
+        raise ValueError(f'{f.name} has a truncated header')
+    return name.decode('ascii')
+
+def pack_record(version, logged_at, body):
+    meta = RECORD_META.pack(version, logged_at)
+    crc = zlib.crc32(body, zlib.crc32(meta))
+    return RECORD_HEADER.pack(len(body), crc) + meta + body
+
+def scan_records(f):
+    # (offset after the record, version, time, body) of every intact record, from
+    # the current position up to the end or the first torn or corrupt record
+    offset = f.tell()
+    while True:
+        header = f.read(RECORD_HEADER.size + RECORD_META.size)
+        if not header:
+            return
+        if len(header) < RECORD_HEADER.size + RECORD_META.size:
+            log.warning('Event log %s ends in a torn record at offset %s', f.name, offset)
+            return
+        length, crc = RECORD_HEADER.unpack_from(header)
+        meta = header[RECORD_HEADER.size:]
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body, zlib.crc32(meta)) != crc:
+            log.warning('Event log %s ends in a torn or corrupt record at offset %s', f.name, offset)
+            return
+        offset += len(header) + length
+        version, logged_at = RECORD_META.unpack(meta)
+        yield offset, version, logged_at, body
+
+def read_event_log(path):
+    # Yields (version, time, decoded message) of every intact record of a log
+    with open(path, 'rb') as f:
+        record_codec = get_codec(read_header(f))
+        for _, version, logged_at, body in scan_records(f):
+            yield version, logged_at, record_codec.decode(body)
+
+class EventLog:
+    # The event loop only queues records; a writer thread writes everything queued
+    # since its last write in one go and then fsyncs once (group commit), so the
+    # fsync cost is shared by every record that arrived while the previous one ran.
+    # Once a group is durable, on_durable(tokens, error) is called on the event loop
+    # with the tokens passed to append for its records, and the OSError if writing failed
+    def __init__(self, path, on_durable, fsync=EVENT_LOG_FSYNC, fresh=False):
+        self.path = path
+        self.on_durable = on_durable
+        self.fsync = fsync
+        # Start a new log rather than append to the one of the previous run
+        self.fresh = fresh
+        self.queue = queue.SimpleQueue()
+        self.loop = None
+        self.file = self.open()
+        self.thread = None
+
+    def open(self):
+        # Append to an existing log of the same codec, cutting off a torn last record
+        if self.fresh and os.path.exists(self.path) and os.path.getsize(self.path):
+            os.replace(self.path, self.path + '.old')
+            log.info('Moved the event log of the previous run to %s.old', self.path)
+        f = open(self.path, 'a+b')
+        f.seek(0)
+        if f.read(1):
+            f.seek(0)
+            codec_name = read_header(f)
+            if codec_name != codec.name:
+                f.close()
+                raise ValueError(f'Event log {self.path} uses codec {codec_name}, not {codec.name}')
+            end = f.tell()
+            records = 0
+            for end, *_ in scan_records(f):
+                records += 1
+            f.truncate(end)
+            log.info('Appending to event log %s after %s records', self.path, records)
+        else:
+            f.write(file_header(codec.name))
+            f.flush()
+            log.info('Started event log %s', self.path)
+        return f
+
+    def start(self, loop):
+        # on_durable is called on loop
+        self.loop = loop
+        self.thread = threading.Thread(target=self.write_records, name='event-log', daemon=True)
+        self.thread.start()
+
+    def append(self, version, body, token=None):
+        # Queue a record, token is handed to on_durable once it is on disk
+        self.queue.put((version, time.time(), body, token))
+
+    def write_records(self):
+        while True:
+            records = [self.queue.get()]
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = records[-1] is None
+            if stop:
+                records.pop()
+            if records:
+                error = None
+                try:
+                    self.file.write(b''.join(pack_record(version, logged_at, body) for version, logged_at, body, _ in records))
+                    self.file.flush()
+                    if self.fsync:
+                        os.fsync(self.file.fileno())
+                except OSError as e:
+                    log.error('Failed to write %s records to event log %s: %s', len(records), self.path, e)
+                    error = e
+                tokens = [token for *_, token in records]
+                self.loop.call_soon_threadsafe(self.on_durable, tokens, error)
+            if stop:
+                return
+
+    def close(self):
+        # Write out what is queued and stop the writer thread, blocks until done
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.file.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Dump a game engine event log as JSONL of update_ge_queue messages')
+    parser.add_argument('path', help='event log file')
+    parser.add_argument('--with-version', action='store_true',
+                        help='wrap each message as {"version": ..., "time": ..., "message": ...} instead')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    output = sys.stdout
+    for version, logged_at, data in read_event_log(args.path):
+        if args.with_version:
+            data = {"version": version, "time": logged_at, "message": data}
+        output.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,29 @@
 #!/usr/bin/env python
 
+import argparse
 import asyncio
-import json
+import collections
+import logging
+import multiprocessing
 import os
+import signal
+import time
 from dotenv import load_dotenv
 import aio_pika
 import aiomqtt
-import purge_queues
+from codec import codec
+from engine_core import DEFAULT_MATCH_ID, MQTT_COALESCE_MS, EngineCore, ScheduleFlush, check_match_id
+from engine_log import Pretty, setup_logging
+from event_log import EVENT_LOG_PATH, EVENT_LOG_RECOVER, EventLog, log_path, read_event_log
+from metrics import metrics
+from rules import RULES_FILE, load_rules
+from tracing import tracer
 
 # Load environment variables from .env file
 load_dotenv()
 
+log = logging.getLogger('game_engine')
+
 # Use the same broker, username, and password for both RabbitMQ and MQTT
 BROKER = os.getenv('BROKER')
 BROKERUSER = os.getenv('BROKERUSER')
@@ -27,19 +40,52 @@ MQTT_PORT = int(os.getenv('MQTT_PORT', '1883'))
 UPDATE_EVAL_SERVER_QUEUE = os.getenv('UPDATE_EVAL_SERVER_QUEUE', 'update_eval_server_queue')
 UPDATE_GE_QUEUE = os.getenv('UPDATE_GE_QUEUE', 'update_ge_queue') 
 
-# MQTT topic
-MQTT_TOPIC_UPDATE_EVERYONE = os.getenv('MQTT_TOPIC_UPDATE_EVERYONE', 'update_everyone')
+# Sharded mode: a supervisor spreads matches over GE_WORKERS engine processes.
+# Matches are routed through a consistent-hash exchange (requires the
+# rabbitmq_consistent_hash_exchange plugin) keyed on match_id, so every message
+# of a match always lands on the same worker and per-match ordering holds
+GE_WORKERS = int(os.getenv('GE_WORKERS', '0'))
+GE_SHARD_EXCHANGE = os.getenv('GE_SHARD_EXCHANGE', 'update_ge_shards')
+
+# Consumer flow control on update_ge_queue: the broker keeps at most GE_PREFETCH
+# unacknowledged messages in flight to this engine (0 is unlimited), and finished
+# messages are acknowledged together, with one multiple=True ack per GE_ACK_BATCH
+# messages, or sooner whenever the engine has caught up with everything received
+GE_PREFETCH = int(os.getenv('GE_PREFETCH', '64'))
+GE_ACK_BATCH = int(os.getenv('GE_ACK_BATCH', '16'))
+
+# MQTT QoS per class of message published to update_everyone. Action results must
+# arrive exactly once, while state refreshes are superseded by the next one anyway
+def mqtt_qos(name, default):
+    # Checked at startup, a bad value would otherwise fail every publish of its class
+    qos = int(os.getenv(name, default))
+    if qos not in (0, 1, 2):
+        raise ValueError(f'{name} must be 0, 1 or 2, not {qos}')
+    return qos
+
+MQTT_QOS = {
+    'action': mqtt_qos('MQTT_QOS_ACTION', '2'),
+    'update': mqtt_qos('MQTT_QOS_UPDATE', '1'),
+    'sync': mqtt_qos('MQTT_QOS_SYNC', '1'),
+}
 
 # Example full schema for messages to and from the game engine
 """
+Messages are shown as JSON; on the wire they use the codec selected by CODEC (see codec.py).
+
 Schema for messages received from 'update_ge_queue' (from various sources):
 
 {
+  "match_id": "court-1",          # Optional, selects the match; omitted means the default match.
+                                  # A non-empty string without +, # or /
+  "end_match": false,             # Optional, ends the match and frees it; nothing else is applied
   "update": true,                 # Indicates whether to send an update to all nodes
   "action": false,                # When true, perform calculations and update the game state
-  "player_id": 1,                 # ID of the player performing the action
+  "player_id": 1,                 # ID of the player performing the action, 1 or 2
   "action_type": "gun",           # Type of action performed
   "hit": true,                    # For 'gun' action, indicates if the shot hit the target
+  "keyframe": false,              # Optional, asks for the full game state to be republished
+  "trace": {"sent": 1718000000.1},  # Optional wall-clock timestamps, echoed to nodes (see tracing.py)
   "game_state": {
     "p1": {
       "opponent_visible": false,
@@ -56,247 +102,620 @@ Schema for messages received from 'update_ge_queue' (from various sources):
   }
 }
 
-Schema for messages published to 'update_everyone' (to Nodes):
+Schema for messages published to 'update_everyone' (to Nodes), or to
+'update_everyone/<match_id>' for messages that carried a match_id:
 
 {
+  "match_id": "court-1",          # Only present for messages that carried a match_id
   "player_id": 1,
   "action": "gun",
-  "game_state": { ... }  # Updated game state after calculations
+  "game_state": { ... },  # Updated game state after calculations
+  "trace": { ... }       # Only present for actions that carried a trace
+}
+
+In delta mode (MQTT_DELTA=true) the game state part is versioned instead, either
+as a keyframe with the full game state:
+
+{
+  "version": 42,
+  "keyframe": true,
+  "game_state": { ... }
+}
+
+or as a delta holding only the fields changed since version "base". A node whose
+version is not "base" has missed a message and should wait for (or ask for) a keyframe:
+
+{
+  "version": 43,
+  "base": 42,
+  "delta": true,
+  "game_state": {"p2": {"hp": 95}}
 }
 
 Schema for messages published to 'update_eval_server_queue' (to Evaluation Server):
 
 {
+  "match_id": "court-1",          # Only present for messages that carried a match_id
   "player_id": 1,
   "action": "gun",
   "game_state": { ... }  # Updated game state after calculations
 }
 """
 
+def shard_queue_name(shard):
+    return f'{UPDATE_GE_QUEUE}.shard{shard}'
+
+def shard_routing_key(match_id):
+    # The consistent-hash exchange hashes the routing key, so use the match_id
+    return '' if match_id is None else str(match_id)
+
+class Sink:
+    # An outbound destination. Publishes of the same match are sent one after another
+    # in the order they were submitted, by a task that lives while the match has
+    # publishes queued; publishes of different matches are in flight at the same time,
+    # so a slow round trip (publisher confirm, MQTT QoS 2) only holds up its own match
+    def __init__(self, name, publish):
+        self.name = name
+        self.publish = publish
+        # Queued (args, future) per match_id, and the tasks draining them
+        self.lanes = {}
+        self.tasks = set()
+
+    async def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.lanes.clear()
+
+    def submit(self, match_id, *args):
+        # Queue a publish and return a future that resolves once it has been sent
+        future = asyncio.get_running_loop().create_future()
+        lane = self.lanes.get(match_id)
+        if lane is None:
+            lane = self.lanes[match_id] = collections.deque()
+            task = asyncio.create_task(self.drain(match_id, lane), name=f'sink-{self.name}-{match_id}')
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        lane.append((args, future))
+        return future
+
+    async def drain(self, match_id, lane):
+        try:
+            while lane:
+                args, future = lane.popleft()
+                try:
+                    if tracer.enabled:
+                        start = time.perf_counter()
+                        await self.publish(*args)
+                        tracer.record(f'{self.name}_publish', time.perf_counter() - start)
+                    else:
+                        await self.publish(*args)
+                except Exception as e:
+                    metrics.publish_failures[self.name] += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    metrics.published[self.name] += 1
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            # Nothing awaits between the empty check and here, so no publish is stranded
+            if self.lanes.get(match_id) is lane:
+                del self.lanes[match_id]
+
+class AckWindow:
+    # Acknowledges deliveries in batches. Messages can finish out of order (one may
+    # wait on a slow publish while a later one has nothing to publish), so only the
+    # contiguous run of finished messages starting at the oldest delivery is acked,
+    # with a single multiple=True ack on the newest successful message of the run
+    def __init__(self, batch):
+        self.batch = max(1, batch)
+        # Received messages in delivery order -> whether they have finished
+        self.pending = collections.OrderedDict()
+        # Newest successful message of the finished run, and how many it would ack
+        self.ack_through = None
+        self.unacked = 0
+
+    def received(self, message):
+        self.pending[message] = False
+
+    async def finished(self, message):
+        self.pending[message] = True
+        await self.advance()
+
+    async def failed(self, message):
+        # Reject a message that could not be processed right away, like message.process()
+        # did. It still closes its place in the run, but is never the ack target since
+        # it is no longer outstanding
+        self.pending[message] = None
+        try:
+            await message.reject(requeue=False)
+        except Exception as e:
+            log.error('Failed to reject message: %s', e)
+        await self.advance()
+
+    async def advance(self):
+        while self.pending:
+            message, finished = next(iter(self.pending.items()))
+            if finished is False:
+                break
+            del self.pending[message]
+            if finished:
+                self.ack_through = message
+                self.unacked += 1
+        if self.ack_through is not None and (self.unacked >= self.batch or not self.pending):
+            message = self.ack_through
+            self.ack_through = None
+            self.unacked = 0
+            try:
+                await message.ack(multiple=True)
+            except Exception as e:
+                # E.g. the channel was closed, the broker redelivers the messages
+                log.error('Failed to acknowledge messages: %s', e)
+
+class MatchActor:
+    # Sole owner of one match's state. Messages (and coalescing flushes) of the match
+    # wait in its mailbox and are handled strictly one after another, each published
+    # before the next one is looked at, while the actors of other matches run
+    # concurrently
+    def __init__(self, engine, match_id):
+        self.engine = engine
+        self.match_id = match_id
+        self.mailbox = asyncio.Queue()
+        self.task = asyncio.create_task(self.run(), name=f'match-{match_id}')
+
+    async def run(self):
+        while True:
+            item = await self.mailbox.get()
+            if isinstance(item, ScheduleFlush):
+                await self.engine.execute(self.engine.core.flush_update(self.match_id))
+            else:
+                await self.engine.apply_message(self.match_id, *item)
+            if self.mailbox.empty() and self.match_id not in self.engine.core.matches:
+                # The match ended (or was never started), retire with it
+                del self.engine.actors[self.match_id]
+                return
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+async def wait_published(submissions):
+    # Wait for publishes on several sinks at once and report failures per sink
+    results = await asyncio.gather(*(future for _, future in submissions), return_exceptions=True)
+    for (sink, _), result in zip(submissions, results):
+        if isinstance(result, Exception):
+            log.error('Failed to publish to %s: %s', sink.name, result)
+
 class GameEngine:
-    def __init__(self):
+    # RabbitMQ and MQTT transport around EngineCore
+    def __init__(self, shard=None, coalesce_ms=MQTT_COALESCE_MS, broker=None):
+        # Worker shard this engine consumes, or None to consume update_ge_queue directly
+        self.shard = shard
+        # In-process broker standing in for RabbitMQ and MQTT (see memory_broker.py),
+        # or None to connect to BROKER
+        self.broker = broker
         self.rabbitmq_connection = None
         self.channel = None
         self.update_ge_queue = None
         self.mqtt_client = None
-        # Initialize internal game state
-        self.game_state = {
-            'p1': {
-                'hp': 100,
-                'bullets': 6,
-                'bombs': 2,
-                'shield_hp': 0,
-                'deaths': 0,
-                'shields': 3,
-                'opponent_visible': False,
-                'opponent_in_rain_bomb': 0,  # Counter for rain bombs
-                'disconnected': False,
-                'login': False
-            },
-            'p2': {
-                'hp': 100,
-                'bullets': 6,
-                'bombs': 2,
-                'shield_hp': 0,
-                'deaths': 0,
-                'shields': 3,
-                'opponent_visible': False,
-                'opponent_in_rain_bomb': 0,
-                'disconnected': False,
-                'login': False
-            }
-        }
+        self.eval_server_sink = Sink('eval_server', self.publish_to_update_eval_server_queue)
+        self.mqtt_sink = Sink('mqtt', self.publish_to_mqtt)
+        self.sinks = {sink.name: sink for sink in (self.eval_server_sink, self.mqtt_sink)}
+        # Game rules and match state, everything network related stays in this class
+        self.core = EngineCore(coalesce_ms=coalesce_ms)
+        # Timers closing coalescing windows
+        self.flush_tasks = set()
+        self.acks = AckWindow(GE_ACK_BATCH)
+        # One actor per match, by match_id, created on the match's first message
+        self.actors = {}
+        # Append-only log of applied messages (see event_log.py), or None
+        self.event_log = None
+        # Acks of messages the event log has made durable
+        self.ack_tasks = set()
 
     async def setup_rabbitmq(self):
         # Set up RabbitMQ connection using aio_pika
-        print('[DEBUG] Connecting to RabbitMQ broker...')
-        self.rabbitmq_connection = await aio_pika.connect_robust(
-            host=BROKER,
-            port=RABBITMQ_PORT,
-            login=BROKERUSER,
-            password=PASSWORD,
-        )
+        log.info('Connecting to RabbitMQ broker...')
+        if self.broker is None:
+            self.rabbitmq_connection = await aio_pika.connect_robust(
+                host=BROKER,
+                port=RABBITMQ_PORT,
+                login=BROKERUSER,
+                password=PASSWORD,
+            )
+        else:
+            self.rabbitmq_connection = await self.broker.connect()
         self.channel = await self.rabbitmq_connection.channel()
-        # Declare the update_ge_queue
-        self.update_ge_queue = await self.channel.declare_queue(UPDATE_GE_QUEUE, durable=True)
-        print(f'[DEBUG] Connected to RabbitMQ broker at {BROKER}:{RABBITMQ_PORT}')
+        if GE_PREFETCH > 0:
+            await self.channel.set_qos(prefetch_count=GE_PREFETCH)
+        metrics.prefetch_count = GE_PREFETCH
+        if self.shard is None:
+            # Declare the update_ge_queue
+            self.update_ge_queue = await self.channel.declare_queue(UPDATE_GE_QUEUE, durable=True)
+        else:
+            # The supervisor has already declared and bound the shard queue
+            self.update_ge_queue = await self.channel.declare_queue(shard_queue_name(self.shard), durable=True)
+        log.info('Connected to RabbitMQ broker at %s:%s', BROKER, RABBITMQ_PORT)
 
-    async def publish_to_update_eval_server_queue(self, message):
-        # Publish message to update_eval_server_queue
-        message_body = json.dumps(message).encode('utf-8')
+    async def publish_to_update_eval_server_queue(self, publish):
+        # Publish the already encoded payload to update_eval_server_queue
         await self.channel.default_exchange.publish(
-            aio_pika.Message(body=message_body),
+            aio_pika.Message(body=publish.payload.body, content_type=codec.content_type),
             routing_key=UPDATE_EVAL_SERVER_QUEUE,
         )
-        print(f'[DEBUG] Published message to {UPDATE_EVAL_SERVER_QUEUE}: {json.dumps(message, indent = 2)}')
-
-    def update_internal_game_state(self, incoming_game_state):
-        # Update internal game state with the incoming data
-        for player_key in ['p1', 'p2']:
-            if player_key in incoming_game_state:
-                self.game_state[player_key].update(incoming_game_state[player_key])
-
-    def perform_action(self, player_id, action_type, data):
-        # Perform calculations based on action_type
-        player_key = f'p{player_id}'
-        opponent_key = 'p1' if player_key == 'p2' else 'p2'
-
-        player = self.game_state[player_key]
-        opponent = self.game_state[opponent_key]
-
-        # Extract necessary data
-        opponent_visible = player.get('opponent_visible', False)
-        opponent_in_rain_bomb = player.get('opponent_in_rain_bomb', 0)
-        hit = data.get('hit', False)
-
-        # Initialize damage variables
-        damage_to_opponent = 0
-        damage_to_shield = 0
-
-        # Handle actions
-        if action_type == 'gun':
-            #When player has ammo
-            if player['bullets'] > 0:
-                player['bullets'] -= 1
-                if hit:
-                    damage_to_opponent = 5  # Gun shot results in -5 HP
-                print(f'[DEBUG] Player {player_id} fired a gun. Bullets left: {player["bullets"]}. Hit: {hit}')
-        elif action_type == 'bomb':
-            if player['bombs'] > 0 and opponent_visible:
-                # Reduce bombs
-                player['bombs'] -= 1
-                print(f'[DEBUG] Player {player_id} threw a bomb. Bombs left: {player["bombs"]}')
-                # Inflict immediate damage
-                damage_to_opponent = 5
-        elif action_type == 'reload':
-            # Can only reload if bullets are zero
-            if player['bullets'] == 0:
-                player['bullets'] = 6
-                print(f'[DEBUG] Player {player_id} reloaded. Bullets: {player["bullets"]}')
-        elif action_type == 'shield':
-            if player['shields'] > 0 and player['shield_hp'] == 0:
-                # Reduce shields count
-                player['shields'] -= 1
-                # Reset shield HP
-                player['shield_hp'] = 30
-                print(f'[DEBUG] Player {player_id} activated a shield. Shields left: {player["shields"]}')
-        elif action_type == 'logout':
-            player['login'] = False
-        elif action_type in ['basket', 'volley', "soccer", "bowl"]:
-            # AI actions inflict damage only if opponent is visible
-            if opponent_visible:
-                damage_to_opponent = 10  # All other attacks result in -10 HP
-        # Handle rain damage
-        if opponent_in_rain_bomb > 0 and opponent_visible:
-            damage_to_opponent += 5 * opponent_in_rain_bomb  # -5 HP per rain bomb active
-
-        # Apply damage to opponent's shield first
-        if opponent['shield_hp'] > 0:
-            if damage_to_opponent > 0:
-                damage_to_shield = min(damage_to_opponent, opponent['shield_hp'])
-                opponent['shield_hp'] -= damage_to_shield
-                damage_to_opponent -= damage_to_shield
-                print(f'[DEBUG] Damage to shield: {damage_to_shield}. Shield HP left: {opponent["shield_hp"]}')
-        else:
-            opponent['shield_hp'] = 0
-
-        # Apply remaining damage to opponent's HP
-        if damage_to_opponent > 0:
-            opponent['hp'] -= damage_to_opponent
-            print(f'[DEBUG] Damage to opponent HP: {damage_to_opponent}. HP left: {opponent["hp"]}')
-            if opponent['hp'] <= 0:
-                opponent['hp'] = 100  # Rebirth with full HP
-                opponent['deaths'] += 1
-                opponent['shields'] = 3
-                opponent['shield_hp'] = 0
-                opponent['bullets'] = 6
-                opponent['bombs'] = 2
-                print(f'[DEBUG] Player {opponent_key[-1]} died and respawned.')
+        log.debug('Published message to %s: %s', UPDATE_EVAL_SERVER_QUEUE, publish.payload)
+
+    async def publish_to_mqtt(self, publish):
+        # Publish the already encoded payload to a match's MQTT topic
+        await self.mqtt_client.publish(publish.topic, publish.payload.body, qos=MQTT_QOS[publish.message_class])
+        log.debug('Published %s message to MQTT topic %s: %s', publish.message_class, publish.topic, publish.payload)
+
+    async def execute(self, effects):
+        # Publish to every sink concurrently and start any coalescing window
+        submissions = []
+        for effect in effects:
+            if isinstance(effect, ScheduleFlush):
+                task = asyncio.create_task(self.flush_after(effect))
+                self.flush_tasks.add(task)
+                task.add_done_callback(self.flush_tasks.discard)
+            else:
+                sink = self.sinks[effect.sink]
+                submissions.append((sink, sink.submit(effect.match_id, effect)))
+        if submissions:
+            await wait_published(submissions)
+
+    async def flush_after(self, schedule):
+        # The flush touches match state, so it goes through the match's mailbox too
+        await asyncio.sleep(schedule.delay)
+        self.actor(schedule.match_id).mailbox.put_nowait(schedule)
+
+    def actor(self, match_id):
+        actor = self.actors.get(match_id)
+        if actor is None:
+            actor = self.actors[match_id] = MatchActor(self, match_id)
+        return actor
+
+    def decode(self, body):
+        if not metrics.enabled:
+            return codec.decode(body)
+        start = time.perf_counter()
+        data = codec.decode(body)
+        metrics.observe_serialization('decode', time.perf_counter() - start)
+        return data
+
+    def decode_traced(self, body, received):
+        # decode with the decode and transit stages timed, see tracing.py
+        received_at = time.time()
+        data = self.decode(body)
+        tracer.record('decode', time.perf_counter() - received)
+        trace = data.get('trace')
+        if isinstance(trace, dict):
+            sent = trace.get('sent')
+            # Clocks of other hosts may be off, a negative transit time means nothing
+            if isinstance(sent, (int, float)) and received_at >= sent:
+                tracer.record('transit', received_at - sent)
+            trace['ge_received'] = received_at
+        return data
 
     async def process_message(self, message: aio_pika.IncomingMessage):
-        async with message.process():
-            print('[DEBUG] Received message from RabbitMQ queue "update_ge_queue"')
-            data = json.loads(message.body.decode('utf-8'))
-            print(f'[DEBUG] Message content:\n{json.dumps(data, indent=2)}')
-
-            action_performed = data.get("action", False)
-            to_update = data.get("update", False)
-            player_id = data.get('player_id')
-            action_type = data.get('action_type')
-            incoming_game_state = data.get('game_state', {})
-
-            # Update internal game state with non-action-related info
-            self.update_internal_game_state(incoming_game_state)
-
-            if action_performed:
-                # Perform action calculations before updating internal state
-                self.perform_action(player_id, action_type, data)
-                # Prepare message to publish
-                mqtt_message = {
-                    "game_state": self.game_state,
-                    "action": action_type,
-                    "player_id": player_id
-                }
-                mqtt_message_str = json.dumps(mqtt_message)
-                # Publish to update_eval_server_queue
-                await self.publish_to_update_eval_server_queue(mqtt_message)
-                
-                # Publish to MQTT topic
-                await self.mqtt_client.publish(
-                    MQTT_TOPIC_UPDATE_EVERYONE,
-                    mqtt_message_str.encode('utf-8'),
-                    qos=2
-                )
-                print(f'[DEBUG] Published message to MQTT topic {MQTT_TOPIC_UPDATE_EVERYONE}: {json.dumps(mqtt_message, indent = 2)}')
-            elif to_update:
-                # Prepare message to publish
-                mqtt_message = {
-                    "game_state": self.game_state
-                }
-                mqtt_message_str = json.dumps(mqtt_message)
-                # Publish to MQTT topic
-                await self.mqtt_client.publish(
-                    MQTT_TOPIC_UPDATE_EVERYONE,
-                    mqtt_message_str.encode('utf-8'),
-                    qos=2
-                )
-                print(f'[DEBUG] Published message to MQTT topic {MQTT_TOPIC_UPDATE_EVERYONE}: {json.dumps(mqtt_message, indent = 2)}')
+        # Consumer callback: only decodes enough to route the message to the mailbox
+        # of its match, whose actor does the rest
+        metrics.messages_consumed += 1
+        metrics.in_flight += 1
+        self.acks.received(message)
+        log.debug('Received message from RabbitMQ queue "%s"', message.routing_key)
+        received = time.perf_counter() if tracer.enabled else None
+        try:
+            if received is not None:
+                data = self.decode_traced(message.body, received)
             else:
-                # Only update internal game state without sending messages
-                print(f'Game state updated internally: {json.dumps(self.game_state, indent=2)}')
-                print('[DEBUG] Updated internal game state without sending any messages')
+                data = self.decode(message.body)
+            log.debug('Message content:\n%s', Pretty(data))
+            actor = self.actor(check_match_id(data.get('match_id', DEFAULT_MATCH_ID)))
+        except Exception as e:
+            log.error('Failed to process message: %s', e)
+            metrics.in_flight -= 1
+            await self.acks.failed(message)
+            return
+        actor.mailbox.put_nowait((message, data, received))
 
-    async def run(self):
-        # Create instance of QueuePurger and purge the queues before running the game engine
-        purger = purge_queues.QueuePurger()
-        print('[DEBUG] Purging queues before starting the game engine...')
-        await purger.run_purge()  # Purge the queues
+    async def apply_message(self, match_id, message, data, received):
+        # Called by the match's actor, one message at a time
+        if received is not None:
+            tracer.record('mailbox', time.perf_counter() - received)
+        logged = False
+        try:
+            effects = self.core.handle_message(data)
+            if self.event_log is not None:
+                # Acked by on_durable once the message is on disk, without holding up the match.
+                # An end_match has removed its match, it is logged with version 0
+                match = self.core.matches.get(match_id)
+                self.event_log.append(match.version if match is not None else 0, message.body, message)
+                logged = True
+            await self.execute(effects)
+        except Exception as e:
+            log.error('Failed to process message: %s', e)
+            if not logged:
+                await self.acks.failed(message)
+        else:
+            if not logged:
+                await self.acks.finished(message)
+        finally:
+            metrics.in_flight -= 1
+            if received is not None:
+                tracer.record('total', time.perf_counter() - received)
+
+    def on_durable(self, messages, error):
+        # A group commit of the event log is on disk. On a write error (logged by the
+        # writer) the messages were still applied and published, so ack them anyway
+        # rather than stall the prefetch window
+        task = asyncio.create_task(self.ack_durable(messages))
+        self.ack_tasks.add(task)
+        task.add_done_callback(self.ack_tasks.discard)
+
+    async def ack_durable(self, messages):
+        for message in messages:
+            await self.acks.finished(message)
+
+    def recover(self, path):
+        # Rebuild the matches by applying the logged messages again, without publishing.
+        # Messages that were not logged yet were never acked, so the broker redelivers
+        # them (run skips the purge). Delivery is at least once: a message logged right
+        # before a crash but not yet acked is applied a second time
+        if not os.path.exists(path):
+            return
+        count = mismatches = 0
+        for version, _, data in read_event_log(path):
+            self.core.handle_message(data)
+            count += 1
+            # Looked up without get_match, which would bring back a match an end_match removed
+            match = self.core.matches.get(data.get('match_id', DEFAULT_MATCH_ID))
+            if (match.version if match is not None else 0) != version:
+                mismatches += 1
+        self.core.pending_updates.clear()
+        # Nodes may have missed the last publishes before the crash
+        for match in self.core.matches.values():
+            match.keyframe_requested = True
+        log.info('Recovered %s matches from %s messages in %s', len(self.core.matches), count, path)
+        if mismatches:
+            log.warning('%s recovered messages ended on another match version than logged, did the rules change?', mismatches)
+
+    async def run(self, purge=True):
+        if EVENT_LOG_RECOVER and purge:
+            # Messages applied but not yet logged are still unacked in the queue, and
+            # are redelivered after the recovered ones only if the queue is kept
+            log.info('Recovering from the event log, not purging queues')
+        elif purge and self.broker is None:
+            # Create instance of QueuePurger and purge the queues before running the game engine.
+            # Imported only here, the in-memory broker and the tests do without it
+            import purge_queues
+            purger = purge_queues.QueuePurger()
+            log.info('Purging queues before starting the game engine...')
+            await purger.run_purge()  # Purge the queues
         
-        # print the starting game state
-        print(f'[DEBUG] Starting game state: {json.dumps(self.game_state, indent=2)}')
+        # Reload the rules file on SIGHUP, e.g. to tune balance between rounds
+        if hasattr(signal, 'SIGHUP'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.core.reload_rules)
+        # Dump the latency histograms on SIGUSR1
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, tracer.dump)
+
+        if EVENT_LOG_PATH:
+            path = log_path(EVENT_LOG_PATH, self.shard)
+            if EVENT_LOG_RECOVER:
+                self.recover(path)
+            # Without recovery this run starts from scratch, and so does its log
+            self.event_log = EventLog(path, self.on_durable, fresh=not EVENT_LOG_RECOVER)
+            self.event_log.start(asyncio.get_running_loop())
+
+        # Create the default match up front and print its starting game state
+        default_match = self.core.get_match(DEFAULT_MATCH_ID)
+        log.debug('Starting game state: %s', Pretty(default_match.game_state))
         
         await self.setup_rabbitmq()
 
         # Set up MQTT client using aiomqtt
-        print('[DEBUG] Connecting to MQTT broker...')
-        async with aiomqtt.Client(
-            hostname=MQTT_BROKER,
-            port=MQTT_PORT,
-            username=BROKERUSER,
-            password=PASSWORD
-        ) as self.mqtt_client:
-            print(f'[DEBUG] Connected to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}')
-            # Start consuming messages
-            await self.update_ge_queue.consume(self.process_message)
-            print('[DEBUG] Started consuming messages from update_ge_queue')
-            # Keep the program running
-            await asyncio.Future()
+        log.info('Connecting to MQTT broker...')
+        if self.broker is None:
+            mqtt_client = aiomqtt.Client(
+                hostname=MQTT_BROKER,
+                port=MQTT_PORT,
+                username=BROKERUSER,
+                password=PASSWORD
+            )
+        else:
+            mqtt_client = self.broker.mqtt_client()
+        async with mqtt_client as self.mqtt_client:
+            log.info('Connected to MQTT broker at %s:%s', MQTT_BROKER, MQTT_PORT)
+            metrics_server = None
+            try:
+                if metrics.enabled:
+                    metrics_server, metrics_monitor = await metrics.serve(self.shard)
+                # Start consuming messages
+                await self.update_ge_queue.consume(self.process_message)
+                log.info('Started consuming messages from %s', self.update_ge_queue.name)
+                # Keep the program running
+                await asyncio.Future()
+            finally:
+                for flush_task in list(self.flush_tasks):
+                    flush_task.cancel()
+                # Copied, actors that retire meanwhile remove themselves from the dict
+                for actor in list(self.actors.values()):
+                    await actor.stop()
+                if self.event_log is not None:
+                    await asyncio.to_thread(self.event_log.close)
+                await self.eval_server_sink.stop()
+                await self.mqtt_sink.stop()
+                if tracer.enabled:
+                    tracer.dump()
+                if metrics_server is not None:
+                    metrics_monitor.cancel()
+                    metrics_server.close()
+
+def run_worker(shard):
+    # Entry point of a worker process started by the Supervisor
+    log_listener = setup_logging()
+    game_engine = GameEngine(shard=shard)
+    try:
+        asyncio.run(game_engine.run(purge=False))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
+
+class Supervisor:
+    def __init__(self, workers):
+        self.workers = workers
+        self.processes = []
+        self.rabbitmq_connection = None
+        self.channel = None
+        self.shard_exchange = None
+        # Forwarded publishes go out in per-match order, and are acked in batches
+        self.forwarder = Sink('shards', self.publish_to_shard)
+        self.acks = AckWindow(GE_ACK_BATCH)
+        self.ack_tasks = set()
+
+    async def setup_shards(self):
+        log.info('Connecting to RabbitMQ broker...')
+        self.rabbitmq_connection = await aio_pika.connect_robust(
+            host=BROKER,
+            port=RABBITMQ_PORT,
+            login=BROKERUSER,
+            password=PASSWORD,
+        )
+        self.channel = await self.rabbitmq_connection.channel()
+        if GE_PREFETCH > 0:
+            await self.channel.set_qos(prefetch_count=GE_PREFETCH)
+        self.shard_exchange = await self.channel.declare_exchange(
+            GE_SHARD_EXCHANGE, type='x-consistent-hash', durable=True
+        )
+        # Bind every shard queue with equal weight before any worker starts, so the
+        # hash ring (and therefore the match to worker mapping) is fixed from the start
+        for shard in range(self.workers):
+            queue = await self.channel.declare_queue(shard_queue_name(shard), durable=True)
+            await queue.bind(self.shard_exchange, routing_key='1')
+            if not EVENT_LOG_RECOVER:
+                await queue.purge()
+        log.info('Declared %s shard queues on exchange %s', self.workers, GE_SHARD_EXCHANGE)
+
+    def start_worker(self, shard):
+        context = multiprocessing.get_context('spawn')
+        process = context.Process(target=run_worker, args=(shard,), name=f'game-engine-{shard}', daemon=True)
+        process.start()
+        log.info('Started worker %s (pid %s)', shard, process.pid)
+        return process
+
+    def start_workers(self):
+        self.processes = [self.start_worker(shard) for shard in range(self.workers)]
+
+    async def watch_workers(self, interval=1.0):
+        # A dead worker leaves its shard queue filling up unnoticed, so restart it
+        while True:
+            await asyncio.sleep(interval)
+            for shard, process in enumerate(self.processes):
+                if not process.is_alive():
+                    log.error('Worker %s (pid %s) exited with code %s, restarting it', shard, process.pid, process.exitcode)
+                    self.processes[shard] = self.start_worker(shard)
+
+    def reload_workers(self):
+        # Pass SIGHUP on so every worker reloads the rules file
+        for process in self.processes:
+            os.kill(process.pid, signal.SIGHUP)
+        log.info('Asked %s workers to reload rules from %s', len(self.processes), RULES_FILE)
+
+    def dump_worker_traces(self):
+        # Pass SIGUSR1 on so every worker dumps its latency histograms
+        for process in self.processes:
+            os.kill(process.pid, signal.SIGUSR1)
+
+    def stop_workers(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    async def publish_to_shard(self, body, routing_key):
+        await self.shard_exchange.publish(
+            aio_pika.Message(body=body, content_type=codec.content_type),
+            routing_key=routing_key,
+        )
+
+    async def forward_update_ge_queue(self):
+        # Producers that still publish to update_ge_queue are re-routed onto the shard
+        # exchange. Messages of a match are forwarded in order, different matches
+        # concurrently, and a message that cannot be routed is rejected on its own
+        update_ge_queue = await self.channel.declare_queue(UPDATE_GE_QUEUE, durable=True)
+        log.info('Forwarding %s to %s', UPDATE_GE_QUEUE, GE_SHARD_EXCHANGE)
+        async with update_ge_queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                self.acks.received(message)
+                try:
+                    match_id = check_match_id(codec.decode(message.body).get('match_id', DEFAULT_MATCH_ID))
+                    forwarded = self.forwarder.submit(match_id, message.body, shard_routing_key(match_id))
+                except Exception as e:
+                    log.error('Failed to route message: %s', e)
+                    await self.acks.failed(message)
+                    continue
+                task = asyncio.create_task(self.ack_forwarded(message, forwarded))
+                self.ack_tasks.add(task)
+                task.add_done_callback(self.ack_tasks.discard)
+
+    async def ack_forwarded(self, message, forwarded):
+        try:
+            await forwarded
+        except Exception as e:
+            log.error('Failed to forward message: %s', e)
+            await self.acks.failed(message)
+        else:
+            await self.acks.finished(message)
+
+    async def run(self):
+        # Purge once for the whole deployment, workers skip their own purge. Workers
+        # recovering from their event logs need the unacked messages kept instead
+        if EVENT_LOG_RECOVER:
+            log.info('Workers recover from their event logs, not purging queues')
+        else:
+            import purge_queues
+            purger = purge_queues.QueuePurger()
+            log.info('Purging queues before starting the game engine workers...')
+            await purger.run_purge()
+
+        # Fail fast on a broken rules file instead of in every worker
+        load_rules()
+
+        await self.setup_shards()
+        self.start_workers()
+        if hasattr(signal, 'SIGHUP'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload_workers)
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.dump_worker_traces)
+        watcher = asyncio.create_task(self.watch_workers())
+        try:
+            await self.forward_update_ge_queue()
+        finally:
+            watcher.cancel()
+            await self.forwarder.stop()
+            self.stop_workers()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='CG4002 game engine')
+    parser.add_argument('--workers', type=int, default=GE_WORKERS,
+                        help='run as a supervisor of this many sharded worker processes (0 runs a single engine)')
+    return parser.parse_args()
 
 if __name__ == '__main__':
-    game_engine = GameEngine()
+    args = parse_args()
+    log_listener = setup_logging()
+    if args.workers > 0:
+        game_engine = Supervisor(args.workers)
+    else:
+        game_engine = GameEngine()
     try:
         asyncio.run(game_engine.run())
     except KeyboardInterrupt:
-        print('[DEBUG] Game engine stopped by user')
+        log.info('Game engine stopped by user')
     except Exception as e:
-        print(f'[ERROR] {e}')
+        log.exception('Game engine stopped: %s', e)
+    finally:
+        log_listener.stop()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+import asyncio
+import random
+
+"""
+In-process stand-in for the RabbitMQ and MQTT brokers, for hermetic load tests.
+
+It implements the part of the aio_pika and aiomqtt surface the game engine uses:
+connection.channel(), channel.declare_queue(), channel.set_qos(),
+channel.default_exchange.publish(), queue.consume() and message.process() on the
+RabbitMQ side, and an async context manager client with publish(), subscribe()
+and a messages iterator on the MQTT side. Every publish can be delayed by a
+configurable latency (plus random jitter) and can fail with a configurable
+probability, raising InjectedFailure.
+
+    broker = InMemoryBroker(latency=0.002, failure_rate=0.01)
+    engine = GameEngine(broker=broker)
+    asyncio.create_task(engine.run())
+"""
+
+class InjectedFailure(ConnectionError):
+    pass
+
+class InMemoryBroker:
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None):
+        # Seconds each publish takes, plus up to jitter seconds more, and the
+        # probability that a publish fails instead
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.queues = {}
+        self.mqtt_clients = []
+
+    async def simulate_network(self, what):
+        delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise InjectedFailure(f'Injected failure publishing to {what}')
+
+    # RabbitMQ side
+
+    async def connect(self):
+        # Counterpart of aio_pika.connect_robust
+        return MemoryConnection(self)
+
+    def queue(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = MemoryQueue(name)
+        return queue
+
+    # MQTT side
+
+    def mqtt_client(self):
+        # Counterpart of aiomqtt.Client, use with async with
+        return MemoryMqttClient(self)
+
+    def deliver_mqtt(self, topic, payload, qos):
+        message = MemoryMqttMessage(topic, payload, qos)
+        for client in self.mqtt_clients:
+            if any(topic_matches(topic_filter, topic) for topic_filter in client.subscriptions):
+                client.inbox.put_nowait(message)
+
+class MemoryConnection:
+    def __init__(self, broker):
+        self.broker = broker
+
+    async def channel(self):
+        return MemoryChannel(self.broker)
+
+    async def close(self):
+        pass
+
+class MemoryChannel:
+    def __init__(self, broker):
+        self.broker = broker
+        self.default_exchange = MemoryExchange(broker)
+        self.prefetch_count = 0
+
+    async def set_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    async def declare_queue(self, name, durable=False, **kwargs):
+        # Every channel gets its own handle on the shared queue, so a consumer is
+        # governed by the prefetch of the channel it consumes on, as in aio_pika
+        return MemoryQueueHandle(self, self.broker.queue(name))
+
+class MemoryQueueHandle:
+    def __init__(self, channel, queue):
+        self.channel = channel
+        self.queue = queue
+        self.name = queue.name
+
+    async def purge(self):
+        await self.queue.purge()
+
+    async def consume(self, callback, no_ack=False):
+        return await self.queue.consume(callback, no_ack, self.channel)
+
+class MemoryExchange:
+    def __init__(self, broker):
+        self.broker = broker
+
+    async def publish(self, message, routing_key, **kwargs):
+        # Like the default exchange, routes to the queue named by the routing key and
+        # drops the message if there is none
+        await self.broker.simulate_network(routing_key)
+        queue = self.broker.queues.get(routing_key)
+        if queue is not None:
+            queue.put(message.body, routing_key, getattr(message, 'content_type', None))
+
+class MemoryQueue:
+    def __init__(self, name):
+        self.name = name
+        self.messages = asyncio.Queue()
+        self.delivery_tag = 0
+        # Delivered but not yet acknowledged, for the channel's prefetch limit
+        self.unacked = set()
+        self.acked = asyncio.Condition()
+        self.consumer_task = None
+        self.callback_tasks = set()
+
+    def put(self, body, routing_key, content_type=None):
+        self.messages.put_nowait((body, routing_key, content_type))
+
+    async def purge(self):
+        while not self.messages.empty():
+            self.messages.get_nowait()
+
+    async def consume(self, callback, no_ack=False, channel=None):
+        self.consumer_task = asyncio.create_task(self.deliver(callback, no_ack, channel))
+        return self.name
+
+    async def deliver(self, callback, no_ack, channel):
+        # Like aio_pika, every delivery runs its callback in a task of its own
+        while True:
+            body, routing_key, content_type = await self.messages.get()
+            prefetch_count = channel.prefetch_count if channel is not None else 0
+            if prefetch_count and not no_ack:
+                async with self.acked:
+                    await self.acked.wait_for(lambda: len(self.unacked) < prefetch_count)
+            self.delivery_tag += 1
+            message = MemoryIncomingMessage(self, body, routing_key, content_type, self.delivery_tag)
+            if not no_ack:
+                self.unacked.add(self.delivery_tag)
+            task = asyncio.create_task(callback(message))
+            self.callback_tasks.add(task)
+            task.add_done_callback(self.callback_tasks.discard)
+
+    async def settle(self, delivery_tag, multiple):
+        if multiple:
+            self.unacked = {tag for tag in self.unacked if tag > delivery_tag}
+        else:
+            self.unacked.discard(delivery_tag)
+        async with self.acked:
+            self.acked.notify_all()
+
+class MemoryIncomingMessage:
+    def __init__(self, queue, body, routing_key, content_type, delivery_tag):
+        self.queue = queue
+        self.body = body
+        self.routing_key = routing_key
+        self.content_type = content_type
+        self.delivery_tag = delivery_tag
+        self.redelivered = False
+        self.processed = False
+
+    async def ack(self, multiple=False):
+        self.processed = True
+        await self.queue.settle(self.delivery_tag, multiple)
+
+    async def reject(self, requeue=False):
+        self.processed = True
+        await self.queue.settle(self.delivery_tag, False)
+        if requeue:
+            self.queue.put(self.body, self.routing_key, self.content_type)
+
+    async def nack(self, multiple=False, requeue=True):
+        await self.reject(requeue=requeue)
+
+    def process(self, requeue=False, ignore_processed=False):
+        return MemoryProcessContext(self, requeue, ignore_processed)
+
+class MemoryProcessContext:
+    # Same contract as aio_pika's message.process(): ack on success, reject on error
+    def __init__(self, message, requeue, ignore_processed):
+        self.message = message
+        self.requeue = requeue
+        self.ignore_processed = ignore_processed
+
+    async def __aenter__(self):
+        return self.message
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if self.ignore_processed and self.message.processed:
+            return
+        if exc_type is None:
+            await self.message.ack()
+        else:
+            await self.message.reject(requeue=self.requeue)
+
+class MemoryMqttClient:
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscriptions = set()
+        self.inbox = asyncio.Queue()
+
+    async def __aenter__(self):
+        self.broker.mqtt_clients.append(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.broker.mqtt_clients.remove(self)
+
+    async def publish(self, topic, payload=None, qos=0, **kwargs):
+        await self.broker.simulate_network(topic)
+        self.broker.deliver_mqtt(topic, payload, qos)
+
+    async def subscribe(self, topic_filter, qos=0, **kwargs):
+        self.subscriptions.add(topic_filter)
+
+    @property
+    def messages(self):
+        return self.iterate_messages()
+
+    async def iterate_messages(self):
+        while True:
+            yield await self.inbox.get()
+
+class MemoryTopic:
+    def __init__(self, value):
+        self.value = value
+
+    def matches(self, topic_filter):
+        return topic_matches(topic_filter, self.value)
+
+    def __str__(self):
+        return self.value
+
+class MemoryMqttMessage:
+    def __init__(self, topic, payload, qos):
+        self.topic = MemoryTopic(topic)
+        self.payload = payload
+        self.qos = qos
+
+def topic_matches(topic_filter, topic):
+    # MQTT topic filter matching with + and # wildcards
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or (level != '+' and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
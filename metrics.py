@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import asyncio
+import collections
+import logging
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+log = logging.getLogger('game_engine')
+
+"""
+Engine metrics in the Prometheus text format, served over plain HTTP on
+GE_METRICS_HOST:GE_METRICS_PORT or on the Unix socket GE_METRICS_SOCKET:
+
+    curl -s localhost:9108/metrics
+    curl -s --unix-socket /run/game_engine.sock localhost/metrics
+
+Sharded workers serve on GE_METRICS_PORT + shard, or GE_METRICS_SOCKET.<shard>.
+Counters are plain attribute updates, so the hot path pays next to nothing for
+them; only the serialization timers are skipped while metrics are off.
+"""
+
+GE_METRICS_HOST = os.getenv('GE_METRICS_HOST', '127.0.0.1')
+GE_METRICS_PORT = int(os.getenv('GE_METRICS_PORT', '0'))
+GE_METRICS_SOCKET = os.getenv('GE_METRICS_SOCKET') or None
+
+# How often the event loop lag is sampled, in seconds
+LOOP_LAG_INTERVAL = 0.5
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    def __init__(self, enabled=bool(GE_METRICS_PORT or GE_METRICS_SOCKET)):
+        self.enabled = enabled
+        self.messages_consumed = 0
+        self.in_flight = 0
+        # Prefetch count of the update_ge_queue channel, 0 means unlimited
+        self.prefetch_count = 0
+        # Performed actions by action type, 'unknown' for types the rules do not know
+        self.actions = collections.Counter()
+        # Publishes by sink
+        self.published = collections.Counter()
+        self.publish_failures = collections.Counter()
+        # Seconds spent and calls, by operation (encode, decode)
+        self.serialization_seconds = collections.Counter()
+        self.serialization_count = collections.Counter()
+        # Event loop lag of the last sample, and the worst since the previous scrape
+        self.loop_lag = 0.0
+        self.loop_lag_max = 0.0
+
+    def observe_serialization(self, operation, seconds):
+        self.serialization_seconds[operation] += seconds
+        self.serialization_count[operation] += 1
+
+    def render(self):
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            # samples: (name suffix, ((label, value), ...), value)
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape(label)}"' for key, label in labels)
+                lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+
+        metric('ge_messages_consumed_total', 'counter', 'Messages consumed from update_ge_queue',
+               [('', (), self.messages_consumed)])
+        metric('ge_messages_in_flight', 'gauge', 'Messages received and not yet fully processed',
+               [('', (), self.in_flight)])
+        metric('ge_prefetch_count', 'gauge', 'Prefetch count of the consumer channel, 0 is unlimited',
+               [('', (), self.prefetch_count)])
+        metric('ge_actions_total', 'counter', 'Actions performed, by action type',
+               [('', (('action_type', action_type),), count) for action_type, count in sorted(self.actions.items())])
+        metric('ge_published_total', 'counter', 'Messages published, by sink',
+               [('', (('sink', sink),), count) for sink, count in sorted(self.published.items())])
+        metric('ge_publish_failures_total', 'counter', 'Failed publishes, by sink',
+               [('', (('sink', sink),), count) for sink, count in sorted(self.publish_failures.items())])
+        serialization = []
+        for operation in sorted(self.serialization_count):
+            labels = (('operation', operation),)
+            serialization.append(('_sum', labels, f'{self.serialization_seconds[operation]:.9f}'))
+            serialization.append(('_count', labels, self.serialization_count[operation]))
+        metric('ge_serialization_seconds', 'summary', 'Time spent encoding and decoding messages', serialization)
+        metric('ge_event_loop_lag_seconds', 'gauge', 'Event loop lag of the last sample',
+               [('', (), f'{self.loop_lag:.6f}')])
+        metric('ge_event_loop_lag_max_seconds', 'gauge', 'Worst event loop lag since the previous scrape',
+               [('', (), f'{self.loop_lag_max:.6f}')])
+        self.loop_lag_max = self.loop_lag
+        return '\n'.join(lines) + '\n'
+
+    async def monitor_loop_lag(self, interval=LOOP_LAG_INTERVAL):
+        # How much later than asked a sleep wakes up is how long callbacks waited to run
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(0.0, loop.time() - start - interval)
+            self.loop_lag_max = max(self.loop_lag_max, self.loop_lag)
+
+    async def handle_request(self, reader, writer):
+        # Just enough HTTP/1.0 for Prometheus and curl: GET /metrics, one request per connection
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while True:
+                header = await asyncio.wait_for(reader.readline(), 5)
+                if header in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.split()
+            path = parts[1].split(b'?')[0] if len(parts) >= 2 else b''
+            if path in (b'/metrics', b'/'):
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f'HTTP/1.0 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('ascii') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            log.debug('Metrics request failed: %s', e)
+        finally:
+            writer.close()
+
+    async def serve(self, shard=None):
+        # Start the metrics server and the loop lag monitor, returns (server, monitor task)
+        if GE_METRICS_SOCKET:
+            path = GE_METRICS_SOCKET if shard is None else f'{GE_METRICS_SOCKET}.{shard}'
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self.handle_request, path)
+            log.info('Serving metrics on unix socket %s', path)
+        else:
+            port = GE_METRICS_PORT if shard is None else GE_METRICS_PORT + shard
+            server = await asyncio.start_server(self.handle_request, GE_METRICS_HOST, port)
+            log.info('Serving metrics on http://%s:%s/metrics', GE_METRICS_HOST, port)
+        monitor = asyncio.create_task(self.monitor_loop_lag(), name='loop-lag-monitor')
+        return server, monitor
+
+# Metrics of this process, shared by the engine core and its transport
+metrics = Metrics()
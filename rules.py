@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+log = logging.getLogger('game_engine')
+
+# Balance rules of the game, compiled into Rules at startup and on SIGHUP
+RULES_FILE = os.getenv('RULES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json'))
+
+"""
+Schema of the rules file:
+
+{
+  "player": {                     # Starting (and respawn) values of every player
+    "hp": 100,
+    "bullets": 6,                 # Also the magazine size restored by 'reload'
+    "bombs": 2,
+    "shields": 3,
+    "shield_hp": 30               # HP of a freshly raised shield
+  },
+  "rain_bomb_damage": 5,          # Damage per active rain bomb on every action
+  "actions": {                    # Every action the engine understands, by action_type
+    "gun": {"type": "attack", "damage": 5, "resource": "bullets", "needs_hit": true},
+    "reload": {"type": "reload"},
+    "shield": {"type": "shield"},
+    "logout": {"type": "logout"},
+    ...
+  }
+}
+
+"attack" actions take "damage" and optionally "resource" (player field consumed),
+"cost" (default 1), "needs_visible" and "needs_hit" (both default false).
+"""
+
+class Action:
+    # Rules of one action type, looked up by name in Rules.actions
+    def __init__(self, name):
+        self.name = name
+
+    def apply(self, player_id, player, hit):
+        # Apply the action to the acting player, returns the damage dealt to the opponent
+        return 0
+
+class Attack(Action):
+    # Deals damage to the opponent, optionally consuming a resource of the player,
+    # requiring the opponent to be visible or only landing on a hit
+    def __init__(self, name, damage, resource=None, cost=1, needs_visible=False, needs_hit=False):
+        super().__init__(name)
+        self.damage = damage
+        self.resource = resource
+        self.cost = cost
+        self.needs_visible = needs_visible
+        self.needs_hit = needs_hit
+
+    def apply(self, player_id, player, hit):
+        if self.needs_visible and not player.opponent_visible:
+            return 0
+        if self.resource is not None:
+            remaining = getattr(player, self.resource) - self.cost
+            if remaining < 0:
+                return 0
+            setattr(player, self.resource, remaining)
+            log.debug('Player %s used %s. %s left: %s. Hit: %s', player_id, self.name, self.resource, remaining, hit)
+        if self.needs_hit and not hit:
+            return 0
+        return self.damage
+
+class Reload(Action):
+    # Refills the magazine, only once it is empty
+    def __init__(self, name, magazine_size):
+        super().__init__(name)
+        self.magazine_size = magazine_size
+
+    def apply(self, player_id, player, hit):
+        if player.bullets == 0:
+            player.bullets = self.magazine_size
+            log.debug('Player %s reloaded. Bullets: %s', player_id, player.bullets)
+        return 0
+
+class Shield(Action):
+    # Raises a fresh shield, only if one is left and none is currently up
+    def __init__(self, name, shield_hp):
+        super().__init__(name)
+        self.shield_hp = shield_hp
+
+    def apply(self, player_id, player, hit):
+        if player.shields > 0 and player.shield_hp == 0:
+            player.shields -= 1
+            player.shield_hp = self.shield_hp
+            log.debug('Player %s activated a shield. Shields left: %s', player_id, player.shields)
+        return 0
+
+class Logout(Action):
+    def apply(self, player_id, player, hit):
+        player.login = False
+        return 0
+
+# Action classes by their "type" in the rules file
+ACTION_TYPES = {
+    'attack': Attack,
+    'reload': Reload,
+    'shield': Shield,
+    'logout': Logout,
+}
+
+PLAYER_FIELDS = ('hp', 'bullets', 'bombs', 'shields', 'shield_hp')
+
+# Player fields an attack may consume
+RESOURCES = ('bullets', 'bombs', 'shields')
+
+class Rules:
+    # Rules file compiled into the values and dispatch table the engine uses
+    def __init__(self, hp, bullets, bombs, shields, shield_hp, rain_bomb_damage, actions):
+        self.hp = hp
+        self.bullets = bullets
+        self.bombs = bombs
+        self.shields = shields
+        self.shield_hp = shield_hp
+        self.rain_bomb_damage = rain_bomb_damage
+        # Dispatch table of every action, unknown action types do nothing
+        self.actions = actions
+
+def compile_rules(config):
+    # Turn a parsed rules file into Rules, raising ValueError on anything malformed
+    try:
+        player = config['player']
+        values = {field: int(player[field]) for field in PLAYER_FIELDS}
+        rain_bomb_damage = int(config['rain_bomb_damage'])
+        actions = {}
+        for name, spec in config['actions'].items():
+            spec = dict(spec)
+            action_type = ACTION_TYPES[spec.pop('type')]
+            if action_type is Reload:
+                actions[name] = Reload(name, values['bullets'])
+            elif action_type is Shield:
+                actions[name] = Shield(name, values['shield_hp'])
+            else:
+                if spec.get('resource', None) not in (None,) + RESOURCES:
+                    raise ValueError(f'{name} consumes unknown resource {spec["resource"]!r}')
+                actions[name] = action_type(name, **spec)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid rules: {e!r}') from e
+    return Rules(rain_bomb_damage=rain_bomb_damage, actions=actions, **values)
+
+def load_rules(path=RULES_FILE):
+    with open(path, 'rb') as rules_file:
+        return compile_rules(json.load(rules_file))
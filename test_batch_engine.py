@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import random
+import numpy as np
+import pytest
+from batch_engine import BatchEngine
+from engine_core import Match
+from rules import load_rules
+
+"""
+Randomized equivalence tests of the game rules:
+
+- Match with the default rules.json against the rules as they were hard-coded in
+  the original game engine (reference_perform_action below)
+- BatchEngine against Match, with waves of one row per match and batches holding
+  many rows of the same match
+
+    python -m pytest -q test_batch_engine.py
+"""
+
+ACTIONS = ('gun', 'bomb', 'reload', 'shield', 'logout', 'basket', 'volley', 'soccer', 'bowl', 'walk')
+
+def initial_game_state():
+    # game_state of the original game engine
+    return {
+        player_key: {
+            'hp': 100,
+            'bullets': 6,
+            'bombs': 2,
+            'shield_hp': 0,
+            'deaths': 0,
+            'shields': 3,
+            'opponent_visible': False,
+            'opponent_in_rain_bomb': 0,
+            'disconnected': False,
+            'login': False
+        }
+        for player_key in ('p1', 'p2')
+    }
+
+def reference_perform_action(game_state, player_id, action_type, data):
+    # perform_action of the original game engine, without its prints
+    player_key = f'p{player_id}'
+    opponent_key = 'p1' if player_key == 'p2' else 'p2'
+    player = game_state[player_key]
+    opponent = game_state[opponent_key]
+    opponent_visible = player.get('opponent_visible', False)
+    opponent_in_rain_bomb = player.get('opponent_in_rain_bomb', 0)
+    hit = data.get('hit', False)
+    damage_to_opponent = 0
+
+    if action_type == 'gun':
+        if player['bullets'] > 0:
+            player['bullets'] -= 1
+            if hit:
+                damage_to_opponent = 5
+    elif action_type == 'bomb':
+        if player['bombs'] > 0 and opponent_visible:
+            player['bombs'] -= 1
+            damage_to_opponent = 5
+    elif action_type == 'reload':
+        if player['bullets'] == 0:
+            player['bullets'] = 6
+    elif action_type == 'shield':
+        if player['shields'] > 0 and player['shield_hp'] == 0:
+            player['shields'] -= 1
+            player['shield_hp'] = 30
+    elif action_type == 'logout':
+        player['login'] = False
+    elif action_type in ['basket', 'volley', 'soccer', 'bowl']:
+        if opponent_visible:
+            damage_to_opponent = 10
+    if opponent_in_rain_bomb > 0 and opponent_visible:
+        damage_to_opponent += 5 * opponent_in_rain_bomb
+
+    if opponent['shield_hp'] > 0:
+        if damage_to_opponent > 0:
+            damage_to_shield = min(damage_to_opponent, opponent['shield_hp'])
+            opponent['shield_hp'] -= damage_to_shield
+            damage_to_opponent -= damage_to_shield
+    else:
+        opponent['shield_hp'] = 0
+
+    if damage_to_opponent > 0:
+        opponent['hp'] -= damage_to_opponent
+        if opponent['hp'] <= 0:
+            opponent['hp'] = 100
+            opponent['deaths'] += 1
+            opponent['shields'] = 3
+            opponent['shield_hp'] = 0
+            opponent['bullets'] = 6
+            opponent['bombs'] = 2
+
+@pytest.mark.parametrize('seed', range(10))
+def test_match_follows_original_rules(seed):
+    rnd = random.Random(seed)
+    game_state = initial_game_state()
+    match = Match('test', load_rules())
+    for step in range(2000):
+        update = {
+            player_key: {'opponent_visible': rnd.random() < 0.7, 'opponent_in_rain_bomb': rnd.choice([0, 0, 0, 1, 2])}
+            for player_key in ('p1', 'p2') if rnd.random() < 0.3
+        }
+        for player_key, values in update.items():
+            game_state[player_key].update(values)
+        match.update_internal_game_state(update)
+        player_id = rnd.choice([1, 2])
+        action_type = rnd.choice(ACTIONS)
+        data = {'hit': rnd.random() < 0.6}
+        reference_perform_action(game_state, player_id, action_type, data)
+        match.perform_action(player_id, action_type, data)
+        assert match.to_wire() == game_state, (seed, step)
+
+def run_batches(seed, matches, steps, rows_per_match):
+    # Random batches of actions and visibility updates applied to both BatchEngine and
+    # one Match per match; rows_per_match=1 makes every batch a single wave
+    rules = load_rules()
+    rnd = np.random.default_rng(seed)
+    batch = BatchEngine(matches, rules)
+    reference = [Match(i, rules) for i in range(matches)]
+    for step in range(steps):
+        updates = 5
+        update_match = rnd.integers(0, matches, updates)
+        update_player = rnd.integers(1, 3, updates)
+        visible = rnd.random(updates) < 0.7
+        rain = rnd.choice([0, 0, 1, 2], updates)
+        for m, player_id, v, r in zip(update_match, update_player, visible, rain):
+            reference[m].update_internal_game_state({f'p{player_id}': {'opponent_visible': bool(v), 'opponent_in_rain_bomb': int(r)}})
+        batch.update_internal_game_state(update_match, update_player, 'opponent_visible', visible)
+        batch.update_internal_game_state(update_match, update_player, 'opponent_in_rain_bomb', rain)
+
+        if rows_per_match == 1:
+            match = rnd.permutation(matches)[:rnd.integers(1, matches + 1)]
+        else:
+            match = rnd.integers(0, matches, rnd.integers(1, matches * rows_per_match))
+        rows = len(match)
+        player_id = rnd.integers(1, 3, rows)
+        action_types = [ACTIONS[i] for i in rnd.integers(0, len(ACTIONS), rows)]
+        hit = rnd.random(rows) < 0.6
+        for m, p, action_type, h in zip(match, player_id, action_types, hit):
+            reference[m].perform_action(int(p), action_type, {'hit': bool(h)})
+        batch.perform_actions(match, player_id, batch.encode_actions(action_types), hit)
+
+        for m in range(matches):
+            assert batch.to_wire(m) == reference[m].to_wire(), (seed, step, m)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_engine_single_row_waves(seed):
+    run_batches(seed, matches=50, steps=200, rows_per_match=1)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_engine_multi_row_waves(seed):
+    run_batches(seed, matches=50, steps=200, rows_per_match=3)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import asyncio
+import logging
+import os
+import aio_pika
+import game_engine
+from codec import codec
+from event_log import EventLog, read_event_log
+from game_engine import UPDATE_GE_QUEUE, GameEngine
+from memory_broker import InMemoryBroker
+
+"""
+Tests of the event log: the file format, torn records, and recovering an engine
+from the log of an engine that ran on an InMemoryBroker.
+
+    python -m pytest -q test_event_log.py
+"""
+
+def gun(match_id, player_id=1):
+    return {"match_id": match_id, "action": True, "player_id": player_id, "action_type": "gun", "hit": True}
+
+async def write_log(path, records):
+    # Write (version, message) records through an EventLog and wait until they are durable
+    durable = []
+    event_log = EventLog(path, lambda tokens, error: durable.extend(tokens), fsync=False)
+    event_log.start(asyncio.get_running_loop())
+    for version, data in records:
+        event_log.append(version, codec.encode(data), version)
+    while len(durable) < len(records):
+        await asyncio.sleep(0.001)
+    await asyncio.to_thread(event_log.close)
+    return durable
+
+def test_message_round_trip(tmp_path):
+    path = str(tmp_path / 'events.log')
+    durable = asyncio.run(write_log(path, [(1, gun('a')), (2, gun('a', 2))]))
+    assert durable == [1, 2]
+    records = list(read_event_log(path))
+    assert [(version, data) for version, _, data in records] == [(1, gun('a')), (2, gun('a', 2))]
+
+def test_torn_last_record_is_cut_off(tmp_path):
+    path = str(tmp_path / 'events.log')
+    asyncio.run(write_log(path, [(1, gun('a')), (2, gun('b'))]))
+    # A crash in the middle of writing the second record
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert [version for version, _, _ in read_event_log(path)] == [1]
+    # Appending cuts the torn record off first, so the new one is readable after it
+    asyncio.run(write_log(path, [(3, gun('c'))]))
+    assert [(version, data) for version, _, data in read_event_log(path)] == [(1, gun('a')), (3, gun('c'))]
+
+def test_fresh_log_moves_the_previous_run_aside(tmp_path):
+    path = str(tmp_path / 'events.log')
+    asyncio.run(write_log(path, [(1, gun('a'))]))
+    EventLog(path, None, fresh=True).close()
+    assert list(read_event_log(path)) == []
+    assert [version for version, _, _ in read_event_log(path + '.old')] == [1]
+
+async def run_engine(messages):
+    # Run an engine on an in-memory broker until every message is acked, then stop it
+    broker = InMemoryBroker()
+    engine = GameEngine(broker=broker, coalesce_ms=0)
+    task = asyncio.create_task(engine.run())
+    queue = broker.queue(UPDATE_GE_QUEUE)
+    connection = await broker.connect()
+    channel = await connection.channel()
+    for data in messages:
+        await channel.default_exchange.publish(aio_pika.Message(body=codec.encode(data)), routing_key=UPDATE_GE_QUEUE)
+    for _ in range(5000):
+        if queue.delivery_tag == len(messages) and not queue.unacked:
+            break
+        await asyncio.sleep(0.001)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert queue.delivery_tag == len(messages) and not queue.unacked
+    return engine
+
+def match_states(core):
+    return {match_id: (match.version, match.to_wire()) for match_id, match in core.matches.items()}
+
+def test_recovery_after_end_match(tmp_path, monkeypatch, caplog):
+    path = str(tmp_path / 'events.log')
+    monkeypatch.setattr(game_engine, 'EVENT_LOG_PATH', path)
+    monkeypatch.setattr(game_engine, 'EVENT_LOG_RECOVER', False)
+    live = asyncio.run(run_engine([
+        gun('a'),
+        gun('a'),
+        {"match_id": "a", "end_match": True},
+        gun('a'),
+        gun('b'),
+        # Rejected, so never logged
+        gun('b', 3),
+        {"match_id": "c", "game_state": {"p1": {"opponent_visible": True}}},
+        {"match_id": "c", "end_match": True},
+    ]))
+    assert set(live.core.matches) == {None, 'a', 'b'}
+    assert live.core.matches['a'].game_state['p2'].hp == 95
+
+    recovered = GameEngine(broker=InMemoryBroker())
+    with caplog.at_level(logging.WARNING, logger='game_engine'):
+        recovered.recover(path)
+    assert 'another match version' not in caplog.text
+    # The default match is created by run, not by any logged message
+    del live.core.matches[None]
+    assert match_states(recovered.core) == match_states(live.core)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import asyncio
+from game_engine import AckWindow
+from memory_broker import MemoryIncomingMessage, MemoryQueue
+
+"""
+Tests of the engine's consumer side that need no broker: AckWindow against the
+delivery bookkeeping of an in-memory queue.
+
+    python -m pytest -q test_game_engine.py
+"""
+
+class RecordingMessage(MemoryIncomingMessage):
+    # Remembers every ack and reject, on the queue they were delivered from
+    async def ack(self, multiple=False):
+        self.queue.settlements.append(('ack', self.delivery_tag, multiple))
+        await super().ack(multiple)
+
+    async def reject(self, requeue=False):
+        self.queue.settlements.append(('reject', self.delivery_tag, requeue))
+        await super().reject(requeue)
+
+def deliver(queue, count):
+    # count deliveries of queue, received by nobody yet
+    queue.settlements = []
+    messages = []
+    for _ in range(count):
+        queue.delivery_tag += 1
+        queue.unacked.add(queue.delivery_tag)
+        messages.append(RecordingMessage(queue, b'{}', queue.name, None, queue.delivery_tag))
+    return messages
+
+def test_acks_only_the_finished_prefix():
+    async def main():
+        queue = MemoryQueue('update_ge_queue')
+        acks = AckWindow(1)
+        messages = deliver(queue, 4)
+        for message in messages:
+            acks.received(message)
+        await acks.finished(messages[2])
+        await acks.finished(messages[1])
+        # The oldest delivery is still being processed, nothing may be acked past it
+        assert queue.settlements == []
+        assert queue.unacked == {1, 2, 3, 4}
+        await acks.finished(messages[0])
+        assert queue.settlements == [('ack', 3, True)]
+        assert queue.unacked == {4}
+        await acks.finished(messages[3])
+        assert queue.settlements[-1] == ('ack', 4, True)
+        assert queue.unacked == set()
+
+    asyncio.run(main())
+
+def test_batches_acks_until_caught_up():
+    async def main():
+        queue = MemoryQueue('update_ge_queue')
+        acks = AckWindow(16)
+        messages = deliver(queue, 3)
+        for message in messages:
+            acks.received(message)
+        for message in reversed(messages):
+            await acks.finished(message)
+        # One multiple=True ack once everything received has finished
+        assert queue.settlements == [('ack', 3, True)]
+        assert queue.unacked == set()
+
+    asyncio.run(main())
+
+def test_acks_around_rejected_messages():
+    async def main():
+        queue = MemoryQueue('update_ge_queue')
+        acks = AckWindow(16)
+        messages = deliver(queue, 4)
+        for message in messages:
+            acks.received(message)
+        await acks.failed(messages[1])
+        await acks.finished(messages[0])
+        await acks.finished(messages[2])
+        # The last one is rejected too, so the ack goes out on the newest success
+        await acks.failed(messages[3])
+        assert queue.settlements == [('reject', 2, False), ('reject', 4, False), ('ack', 3, True)]
+        assert queue.unacked == set()
+
+    asyncio.run(main())
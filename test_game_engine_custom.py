@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
+import argparse
 import asyncio
+import collections
 import json
+import logging
 import os
+import time
 from dotenv import load_dotenv
 import aio_pika
+import aiomqtt
+from codec import codec
+from engine_core import MQTT_TOPIC_UPDATE_EVERYONE, match_topic
+from engine_log import setup_logging
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,23 +22,72 @@ BROKER = os.getenv('BROKER')
 BROKERUSER = os.getenv('BROKERUSER')
 PASSWORD = os.getenv('PASSWORD')
 RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
+MQTT_PORT = int(os.getenv('MQTT_PORT', '1883'))
 
 # RabbitMQ queues
-UPDATE_GE_QUEUE = 'update_ge_queue'
+UPDATE_GE_QUEUE = os.getenv('UPDATE_GE_QUEUE', 'update_ge_queue')
+
+# Default scenario, next to this file
+SCENARIO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_scenario.json')
+
+"""
+Load generator for the game engine. Drives a number of virtual matches concurrently,
+each replaying the scenario's script of update_ge_queue messages in a loop, at a
+target total rate. Actions carry a trace timestamp (see tracing.py) that the engine
+echoes in the action result it publishes on update_everyone/<match_id>, which gives
+the end-to-end latency. Results without one are matched to the oldest unanswered
+action of their match instead, which a lost result shifts.
+
+Scenario file (JSON), any of the first three can be overridden on the command line:
+
+{
+  "matches": 20,        # Concurrent matches, each with its own match_id
+  "rate": 1000,         # Target messages per second over all matches
+  "duration": 10,       # Seconds to send for
+  "script": [ ... ]     # update_ge_queue messages played in order by every match
+}
+
+    python test_game_engine_custom.py load_scenario.json --rate 2000
+    python test_game_engine_custom.py --memory --latency 2 --failure-rate 0.01
+
+With --memory the engine runs in this process on an InMemoryBroker, no broker needed.
+"""
+
+PERCENTILES = (50, 95, 99)
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an already sorted list
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
 
 class GameEngineTest:
-    def __init__(self):
+    def __init__(self, scenario, broker=None, drain_timeout=5.0):
+        self.scenario = scenario
+        # In-process broker shared with an in-process engine, or None to connect to BROKER
+        self.broker = broker
+        self.drain_timeout = drain_timeout
         self.rabbitmq_connection = None
         self.channel = None
+        self.mqtt_client = None
+        self.sent = 0
+        self.send_failures = 0
+        self.actions_sent = 0
+        self.results = 0
+        self.latencies = []
+        # Send times of actions still waiting for their result, per MQTT topic
+        self.pending = collections.defaultdict(collections.deque)
 
     async def setup_rabbitmq(self):
         # Connect to RabbitMQ
-        self.rabbitmq_connection = await aio_pika.connect_robust(
-            host=BROKER,
-            port=RABBITMQ_PORT,
-            login=BROKERUSER,
-            password=PASSWORD,
-        )
+        if self.broker is None:
+            self.rabbitmq_connection = await aio_pika.connect_robust(
+                host=BROKER,
+                port=RABBITMQ_PORT,
+                login=BROKERUSER,
+                password=PASSWORD,
+            )
+        else:
+            self.rabbitmq_connection = await self.broker.connect()
         self.channel = await self.rabbitmq_connection.channel()
         # Declare queues
         await self.channel.declare_queue(UPDATE_GE_QUEUE, durable=True)
@@ -38,100 +95,153 @@ class GameEngineTest:
 
     async def send_test_message(self, message):
         # Publish message to update_ge_queue
-        message_body = json.dumps(message).encode('utf-8')
+        message_body = codec.encode(message)
         await self.channel.default_exchange.publish(
-            aio_pika.Message(body=message_body),
+            aio_pika.Message(body=message_body, content_type=codec.content_type),
             routing_key=UPDATE_GE_QUEUE,
         )
-        print(f'[DEBUG] Published test message to {UPDATE_GE_QUEUE}: {message}')
-
-    async def run_test(self):
-        await self.setup_rabbitmq()
-
-        while True:
-            # Get custom inputs from user
-            player_id_input = input('Enter player ID (integer) or type "no" to exit: ')
-            if player_id_input.lower() == 'no':
-                print('Exiting...')
-                break
 
+    async def run_match(self, match_id, interval, start, deadline):
+        # Play the script for one match, one message every interval seconds. Messages
+        # of a match are sent one after another so the engine sees them in order
+        topic = match_topic(match_id)
+        script = self.scenario['script']
+        next_send = start
+        step = 0
+        while next_send < deadline:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            message = dict(script[step % len(script)], match_id=match_id)
+            is_action = message.get('action', False)
+            if is_action:
+                message['trace'] = {'sent': time.time()}
+                self.pending[topic].append(time.perf_counter())
             try:
-                player_id = int(player_id_input)
-            except ValueError:
-                print("Invalid input. Please enter a valid integer or 'no' to exit.")
+                await self.send_test_message(message)
+            except Exception as e:
+                self.send_failures += 1
+                if is_action:
+                    self.pending[topic].pop()
+                print(f'[DEBUG] Failed to publish to {UPDATE_GE_QUEUE}: {e}')
+            else:
+                self.sent += 1
+                self.actions_sent += is_action
+            step += 1
+            # Falling behind sends the backlog as fast as possible rather than skipping it
+            next_send += interval
+
+    async def collect_results(self):
+        async for message in self.mqtt_client.messages:
+            data = codec.decode(message.payload)
+            if 'action' not in data:
                 continue
+            pending = self.pending.get(message.topic.value)
+            if pending:
+                sent = pending.popleft()
+                trace = data.get('trace')
+                if isinstance(trace, dict) and 'sent' in trace:
+                    self.latencies.append(time.time() - trace['sent'])
+                else:
+                    self.latencies.append(time.perf_counter() - sent)
+                self.results += 1
 
-            # Provide available action types and get input
-            action_type = input(
-                'Enter action type (available: gun, soccer, basket, shield, volley, bomb, bowl, logout) or type "no" to exit: '
-            ).lower()
-            
-            if action_type == 'no':
-                print('Exiting...')
-                break
-
-            available_actions = ['gun', 'soccer', 'basket', 'shield', 'volley', 'bomb', 'bowl', 'logout', 'reload']
-            if action_type not in available_actions:
-                print(f"Invalid action type. Please choose from {', '.join(available_actions)} or 'no' to exit.")
-                continue
+    async def run_test(self):
+        engine_task = None
+        if self.broker is not None:
+            # Imported here so this script stays importable (e.g. by pytest collection)
+            # where the engine's broker dependencies are not installed
+            from game_engine import GameEngine
+            engine_task = asyncio.create_task(GameEngine(broker=self.broker).run())
+        await self.setup_rabbitmq()
 
-            # Simulating player action detected from wearables / rain bomb damage tick in visualizer
-            # test_message = {
-            #     'action': True,
-            #     'player_id': player_id,
-            #     'action_type': action_type,
-            #     'hit': True,
-            #     'game_state': {
-            #         'p1': {'opponent_visible': True,
-            #                'opponent_in_rain_bomb': 2},
-            #         'p2': {'opponent_visible': True,
-            #                'opponent_in_rain_bomb': 0}
-            #     }
-            # }
-            
-            # Simulate Game Engine updates from eval server
-            # test_message = {
-            #     'update': True,
-            #     'game_state': {
-            #         'p1': {
-            #             'hp': 90,
-            #             'bullets': 6,
-            #             'bombs': 2,
-            #             'shield_hp': 0,
-            #             'deaths': 0,
-            #             'shields': 3,
-            #         },
-            #         'p2': {
-            #             'hp': 100,
-            #             'bullets': 6,
-            #             'bombs': 2,
-            #             'shield_hp': 0,
-            #             'deaths': 0,
-            #             'shields': 3,
-            #         }
-            #     }
-            # }
-            
-            # Simulate visualizer communications with server
-            # test_message = {
-            #     'game_state': {
-            #         'p1': {'opponent_visible': True,
-            #                'opponent_in_rain_bomb': 2},
-            #         'p2': {'opponent_visible': True,
-            #                'opponent_in_rain_bomb': 2}
-            #     }
-            # }
-            
-            # Send the test message
-            await self.send_test_message(test_message)
+        if self.broker is None:
+            mqtt_client = aiomqtt.Client(
+                hostname=BROKER,
+                port=MQTT_PORT,
+                username=BROKERUSER,
+                password=PASSWORD
+            )
+        else:
+            mqtt_client = self.broker.mqtt_client()
+        async with mqtt_client as self.mqtt_client:
+            await self.mqtt_client.subscribe(f'{MQTT_TOPIC_UPDATE_EVERYONE}/#', qos=1)
+            collector = asyncio.create_task(self.collect_results())
+
+            matches = self.scenario['matches']
+            rate = self.scenario['rate']
+            print(f'[DEBUG] Sending {rate:g} msg/s over {matches} matches for {self.scenario["duration"]}s')
+            start = time.perf_counter()
+            deadline = start + self.scenario['duration']
+            # Stagger the matches so the combined stream is evenly spaced
+            await asyncio.gather(*(
+                self.run_match(f'load-{match}', matches / rate, start + match / rate, deadline)
+                for match in range(matches)
+            ))
+            send_elapsed = time.perf_counter() - start
+
+            # Wait for the results of the last actions
+            drain_deadline = time.perf_counter() + self.drain_timeout
+            while any(self.pending.values()) and time.perf_counter() < drain_deadline:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            collector.cancel()
+            await asyncio.gather(collector, return_exceptions=True)
 
         # Close RabbitMQ connection after finishing
         await self.rabbitmq_connection.close()
-
+        if engine_task is not None:
+            engine_task.cancel()
+            await asyncio.gather(engine_task, return_exceptions=True)
+        self.report(send_elapsed, elapsed)
+
+    def report(self, send_elapsed, elapsed):
+        rate = self.scenario['rate']
+        print(f'Sent {self.sent} messages ({self.actions_sent} actions) in {send_elapsed:.2f}s: '
+              f'{self.sent / send_elapsed:.0f} msg/s (target {rate:g} msg/s), {self.send_failures} failed')
+        missing = sum(len(pending) for pending in self.pending.values())
+        print(f'Received {self.results} action results in {elapsed:.2f}s: '
+              f'{self.results / elapsed:.0f} msg/s, {missing} missing')
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            percentiles = ', '.join(f'p{p} {percentile(latencies, p) * 1000:.2f}' for p in PERCENTILES)
+            print(f'End-to-end latency (ms): {percentiles}, max {latencies[-1] * 1000:.2f}')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load generator for the game engine')
+    parser.add_argument('scenario', nargs='?', default=SCENARIO_FILE, help='scenario file')
+    parser.add_argument('--matches', type=int, help='concurrent matches (overrides the scenario)')
+    parser.add_argument('--rate', type=float, help='target messages per second (overrides the scenario)')
+    parser.add_argument('--duration', type=float, help='seconds to send for (overrides the scenario)')
+    parser.add_argument('--drain-timeout', type=float, default=5.0, help='seconds to wait for outstanding results')
+    parser.add_argument('--memory', action='store_true', help='run the engine in process on an in-memory broker')
+    parser.add_argument('--latency', type=float, default=0.0, help='--memory: milliseconds per publish')
+    parser.add_argument('--jitter', type=float, default=0.0, help='--memory: up to this many extra milliseconds per publish')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='--memory: probability a publish fails')
+    return parser.parse_args()
+
+def load_scenario(args):
+    with open(args.scenario) as f:
+        scenario = json.load(f)
+    for key in ('matches', 'rate', 'duration'):
+        if getattr(args, key) is not None:
+            scenario[key] = getattr(args, key)
+    if not scenario.get('script'):
+        raise ValueError(f'Scenario {args.scenario} has no script')
+    return scenario
 
 if __name__ == '__main__':
-    test = GameEngineTest()
+    args = parse_args()
+    # Only the engine's warnings, in --memory mode its logs would drown the report
+    log_listener = setup_logging(logging.WARNING)
+    broker = None
+    if args.memory:
+        from memory_broker import InMemoryBroker
+        broker = InMemoryBroker(latency=args.latency / 1000, jitter=args.jitter / 1000, failure_rate=args.failure_rate)
+    test = GameEngineTest(load_scenario(args), broker=broker, drain_timeout=args.drain_timeout)
     try:
         asyncio.run(test.run_test())
     except KeyboardInterrupt:
         print('Process interrupted. Exiting...')
+    finally:
+        log_listener.stop()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import logging
+import math
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+log = logging.getLogger('game_engine')
+
+"""
+Per-stage latency tracing. With GE_TRACE=true the engine times every stage of a
+message and aggregates the timings into histograms, dumped to the log on SIGUSR1
+and at shutdown:
+
+    transit           producer's trace.sent to receipt by the engine (wall clock)
+    decode            codec.decode of the message body
+    mailbox           receipt to the match's actor picking the message up
+    state_update      update_internal_game_state
+    perform_action    perform_action
+    eval_server_publish, mqtt_publish
+                      the publish itself, once the sink gets to it
+    total             receipt to every publish of the message done
+
+Producers opt in to transit timing by adding a "trace" object of wall-clock
+timestamps (time.time(), seconds) to the message, e.g. "trace": {"sent": 1718000000.123}.
+The engine adds "ge_received" to it and echoes it in the action result on
+update_everyone, so nodes can measure the whole path too.
+"""
+
+GE_TRACE = os.getenv('GE_TRACE', 'false').lower() == 'true'
+
+# Order of the stages in dumps, stages not listed here follow in first-seen order
+STAGES = ('transit', 'decode', 'mailbox', 'state_update', 'perform_action', 'eval_server_publish', 'mqtt_publish', 'total')
+PERCENTILES = (50, 95, 99)
+
+# Histogram buckets: everything up to MIN_SECONDS, then BUCKETS_PER_OCTAVE buckets per
+# doubling up to MAX_SECONDS, so percentiles are exact to within about 4%
+MIN_SECONDS = 1e-6
+MAX_SECONDS = 100.0
+BUCKETS_PER_OCTAVE = 16
+BUCKETS = math.ceil(math.log2(MAX_SECONDS / MIN_SECONDS) * BUCKETS_PER_OCTAVE) + 2
+
+class Histogram:
+    # Fixed log-scale buckets, recording is O(1) and memory stays constant
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= MIN_SECONDS:
+            index = 0
+        else:
+            index = min(BUCKETS - 1, int(math.log2(seconds / MIN_SECONDS) * BUCKETS_PER_OCTAVE) + 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile, capped at the maximum
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(MIN_SECONDS * 2 ** (index / BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+class Tracer:
+    def __init__(self, enabled=GE_TRACE):
+        self.enabled = enabled
+        self.histograms = {}
+
+    def record(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(seconds)
+
+    def report(self):
+        # One line per stage, latencies in milliseconds
+        stages = [stage for stage in STAGES if stage in self.histograms]
+        stages += [stage for stage in self.histograms if stage not in STAGES]
+        lines = [f'{"stage":<20} {"count":>9} {"mean":>9} ' + ' '.join(f'{"p" + str(p):>9}' for p in PERCENTILES) + f' {"max":>9}']
+        for stage in stages:
+            histogram = self.histograms[stage]
+            if not histogram.count:
+                continue
+            percentiles = ' '.join(f'{histogram.percentile(p) * 1000:9.3f}' for p in PERCENTILES)
+            lines.append(f'{stage:<20} {histogram.count:>9} {histogram.total / histogram.count * 1000:9.3f} '
+                         f'{percentiles} {histogram.max * 1000:9.3f}')
+        return '\n'.join(lines)
+
+    def dump(self):
+        if not self.enabled:
+            log.info('Latency tracing is off, set GE_TRACE=true to enable it')
+            return
+        log.info('Latency per stage (ms):\n%s', self.report())
+
+# Tracer of this process, shared by the engine core and its transport
+tracer = Tracer()